@@ -1,28 +1,186 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Depends, Query, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import HTTPConnection
+from starlette.routing import Match
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne, monitoring
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
+import time
+import random
+import bisect
+import hmac
+import ipaddress
+import threading
+import contextvars
+import tracemalloc
+import re
+import hashlib
+import gzip
+import base64
+import asyncio
+import argparse
+import json
+import sys
+import jwt
+from collections import OrderedDict, deque
 from datetime import datetime, timezone, timedelta
 import httpx
+import numpy as np
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection (the client is created after the METRICS and PROFILING
+# sections so their command listeners can be attached)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+
+# Background write pipeline setup for post-reply chat persistence
+WRITE_QUEUE_ENABLED = os.environ.get('WRITE_QUEUE_ENABLED', 'true').lower() == 'true'
+WRITE_QUEUE_MAX_SIZE = int(os.environ.get('WRITE_QUEUE_MAX_SIZE', '1000'))
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', '100'))
+WRITE_MAX_RETRIES = int(os.environ.get('WRITE_MAX_RETRIES', '3'))
+WRITE_RETRY_BACKOFF_SECONDS = float(os.environ.get('WRITE_RETRY_BACKOFF_SECONDS', '0.2'))
+
+# Prompt layout: "inline" prefixes history to the user message, "messages"
+# sends it as append-only structured turns so the prompt prefix stays stable
+PROMPT_LAYOUT = os.environ.get('PROMPT_LAYOUT', 'inline').lower()
+
+# LLM response cache setup for repeated openers
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_MAX_SIZE = int(os.environ.get('RESPONSE_CACHE_MAX_SIZE', '5000'))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '86400'))
+RESPONSE_CACHE_MAX_HISTORY = int(os.environ.get('RESPONSE_CACHE_MAX_HISTORY', '0'))
+RESPONSE_CACHE_MAX_MESSAGE_CHARS = int(os.environ.get('RESPONSE_CACHE_MAX_MESSAGE_CHARS', '40'))
+RESPONSE_CACHE_MONGO_ENABLED = os.environ.get('RESPONSE_CACHE_MONGO_ENABLED', 'false').lower() == 'true'
+
+# Per-session chat history cache setup
+HISTORY_CACHE_ENABLED = os.environ.get('HISTORY_CACHE_ENABLED', 'true').lower() == 'true'
+HISTORY_CACHE_MESSAGES_PER_SESSION = int(os.environ.get('HISTORY_CACHE_MESSAGES_PER_SESSION', '100'))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+HISTORY_CACHE_IDLE_SECONDS = float(os.environ.get('HISTORY_CACHE_IDLE_SECONDS', '1800'))
+
+# Context window setup: token budget for history plus a rolling summary of
+# older turns once a session grows past the trigger
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '1500'))
+CONTEXT_SUMMARY_ENABLED = os.environ.get('CONTEXT_SUMMARY_ENABLED', 'true').lower() == 'true'
+CONTEXT_SUMMARY_TRIGGER_MESSAGES = int(os.environ.get('CONTEXT_SUMMARY_TRIGGER_MESSAGES', '20'))
+CONTEXT_SUMMARY_KEEP_MESSAGES = int(os.environ.get('CONTEXT_SUMMARY_KEEP_MESSAGES', '10'))
+CONTEXT_SUMMARY_MODEL = os.environ.get('CONTEXT_SUMMARY_MODEL', 'gpt-4.1-mini')
+
+# Tokenizer setup: directory holding the o200k_base BPE file in tiktoken's
+# cache layout; empty uses the copy bundled with litellm
+TOKENIZER_CACHE_DIR = os.environ.get('TIKTOKEN_CACHE_DIR', '')
+TOKENIZER_LOAD_TIMEOUT_SECONDS = float(os.environ.get('TOKENIZER_LOAD_TIMEOUT_SECONDS', '10'))
+
+# XP event buffer setup: coalesces $inc xp writes per user
+XP_BUFFER_ENABLED = os.environ.get('XP_BUFFER_ENABLED', 'true').lower() == 'true'
+XP_FLUSH_INTERVAL_SECONDS = float(os.environ.get('XP_FLUSH_INTERVAL_SECONDS', '1'))
+XP_FLUSH_MAX_USERS = int(os.environ.get('XP_FLUSH_MAX_USERS', '500'))
+
+# Conversation Combat WebSocket setup
+WS_HEARTBEAT_SECONDS = float(os.environ.get('WS_HEARTBEAT_SECONDS', '20'))
+WS_IDLE_TIMEOUT_SECONDS = float(os.environ.get('WS_IDLE_TIMEOUT_SECONDS', '120'))
+WS_SEND_TIMEOUT_SECONDS = float(os.environ.get('WS_SEND_TIMEOUT_SECONDS', '10'))
+WS_MAX_PENDING_MESSAGES = int(os.environ.get('WS_MAX_PENDING_MESSAGES', '4'))
+
+# Quiz scoring setup: optional JSON file of per-question option weights
+QUIZ_WEIGHTS_FILE = os.environ.get('QUIZ_WEIGHTS_FILE', '')
+QUIZ_RESCORE_BATCH_SIZE = int(os.environ.get('QUIZ_RESCORE_BATCH_SIZE', '1000'))
+
+# Metrics setup: /metrics only answers direct requests from these networks
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(network.strip())
+    for network in os.environ.get('METRICS_ALLOWED_NETWORKS', '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16').split(',')
+    if network.strip()
+]
+
+# Profiler setup: a request carrying X-Profile-Request: PROFILER_TOKEN, or any
+# request during an admin-started window, is sampled into a folded-stack profile
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN', '')
+PROFILER_INTERVAL_SECONDS = float(os.environ.get('PROFILER_INTERVAL_SECONDS', '0.005'))
+PROFILER_MAX_PROFILES = int(os.environ.get('PROFILER_MAX_PROFILES', '20'))
+PROFILER_MAX_WINDOW_SECONDS = float(os.environ.get('PROFILER_MAX_WINDOW_SECONDS', '300'))
+PROFILER_OUTPUT_DIR = os.environ.get('PROFILER_OUTPUT_DIR', '')
+
+# Memory accounting setup: tracemalloc stays off until an admin starts it
+MEMORY_TRACE_FRAMES = int(os.environ.get('MEMORY_TRACE_FRAMES', '1'))
+MEMORY_MAX_SNAPSHOTS = int(os.environ.get('MEMORY_MAX_SNAPSHOTS', '5'))
+MEMORY_MAX_WINDOW_SECONDS = float(os.environ.get('MEMORY_MAX_WINDOW_SECONDS', '3600'))
+
+# Static content caching setup
+STATIC_CACHE_MAX_AGE = int(os.environ.get('STATIC_CACHE_MAX_AGE', '3600'))
+
+# Delta sync setup for the mobile offline cache
+SYNC_BATCH_MAX = int(os.environ.get('SYNC_BATCH_MAX', '500'))
+SYNC_SETTLE_SECONDS = float(os.environ.get('SYNC_SETTLE_SECONDS', '10'))
+
+# Bulk journal upload setup for entries queued while offline
+JOURNAL_BULK_MAX_ENTRIES = int(os.environ.get('JOURNAL_BULK_MAX_ENTRIES', '100'))
+
+# Dashboard setup: how much recent activity the launch screen shows
+DASHBOARD_RECENT_ENTRIES = int(os.environ.get('DASHBOARD_RECENT_ENTRIES', '5'))
+DASHBOARD_RECENT_SESSIONS = int(os.environ.get('DASHBOARD_RECENT_SESSIONS', '5'))
+DASHBOARD_SESSION_SCAN_MESSAGES = int(os.environ.get('DASHBOARD_SESSION_SCAN_MESSAGES', '200'))
+
+# Batch endpoint setup: sub-requests allowed in one /api/batch call
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '20'))
+
+# Index bootstrap setup: "log" or "fail" when an existing index conflicts
+INDEX_CONFLICT_POLICY = os.environ.get('INDEX_CONFLICT_POLICY', 'log').lower()
 
 # LLM setup
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
+# OpenAI-compatible endpoint for streamed completions, which go to litellm
+# directly; empty sends each reply as a single chunk through LlmChat
+LLM_API_BASE = os.environ.get('LLM_API_BASE', '')
+
+# LLM mode setup: "live" calls the model, "record" also appends every exchange
+# with its timings to LLM_RECORDING_FILE, "replay" serves recorded exchanges
+# locally with no network, optionally injecting errors and timeouts
+LLM_MODE = os.environ.get('LLM_MODE', 'live').lower()
+LLM_RECORDING_FILE = os.environ.get('LLM_RECORDING_FILE', str(ROOT_DIR / 'llm_recordings.jsonl'))
+LLM_REPLAY_TIME_SCALE = float(os.environ.get('LLM_REPLAY_TIME_SCALE', '1'))
+LLM_REPLAY_ERROR_RATE = float(os.environ.get('LLM_REPLAY_ERROR_RATE', '0'))
+LLM_REPLAY_TIMEOUT_RATE = float(os.environ.get('LLM_REPLAY_TIMEOUT_RATE', '0'))
+LLM_REPLAY_TIMEOUT_SECONDS = float(os.environ.get('LLM_REPLAY_TIMEOUT_SECONDS', '60'))
+LLM_REPLAY_SEED = int(os.environ.get('LLM_REPLAY_SEED', '0'))
+
+if LLM_MODE not in ("live", "record", "replay"):
+    raise RuntimeError(f"Unknown LLM_MODE: {LLM_MODE}")
+
+# Shared HTTP client pool setup
+HTTP_POOL_MAX_CONNECTIONS = int(os.environ.get('HTTP_POOL_MAX_CONNECTIONS', '100'))
+HTTP_POOL_MAX_KEEPALIVE = int(os.environ.get('HTTP_POOL_MAX_KEEPALIVE', '20'))
+HTTP_POOL_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_POOL_KEEPALIVE_EXPIRY', '30'))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', '5'))
+AUTH_HTTP_TIMEOUT_SECONDS = float(os.environ.get('AUTH_HTTP_TIMEOUT_SECONDS', '10'))
+LLM_HTTP_TIMEOUT_SECONDS = float(os.environ.get('LLM_HTTP_TIMEOUT_SECONDS', '60'))
+
+# Auth cache setup
+AUTH_CACHE_ENABLED = os.environ.get('AUTH_CACHE_ENABLED', 'true').lower() == 'true'
+AUTH_CACHE_MAX_SIZE = int(os.environ.get('AUTH_CACHE_MAX_SIZE', '10000'))
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get('AUTH_CACHE_TTL_SECONDS', '60'))
+
+# Auth mode setup: "session" looks tokens up in user_sessions, "signed" issues
+# HMAC-signed tokens that are verified without a database read
+AUTH_MODE = os.environ.get('AUTH_MODE', 'session').lower()
+AUTH_TOKEN_SECRET = os.environ.get('AUTH_TOKEN_SECRET', '')
+AUTH_TOKEN_ALGORITHM = "HS256"
+REVOKED_TOKEN_REFRESH_SECONDS = float(os.environ.get('REVOKED_TOKEN_REFRESH_SECONDS', '30'))
+
+if AUTH_MODE == "signed" and not AUTH_TOKEN_SECRET:
+    raise RuntimeError("AUTH_TOKEN_SECRET is required when AUTH_MODE=signed")
 
 # Create the main app
 app = FastAPI()
@@ -93,15 +251,22 @@ class JournalEntry(BaseModel):
     entry_type: str  # "journal", "affirmation", "reflection"
     content: str
     mood: Optional[str] = None
+    idempotency_key: Optional[str] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class JournalEntryCreate(BaseModel):
     entry_type: str
     content: str
     mood: Optional[str] = None
+    idempotency_key: Optional[str] = Field(None, min_length=1, max_length=128)
+
+class JournalEntryBulkCreate(BaseModel):
+    entries: List[JournalEntryCreate] = Field(..., min_length=1, max_length=JOURNAL_BULK_MAX_ENTRIES)
 
 class ChatMessage(BaseModel):
-    message_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    # ObjectId hex ids sort in creation order within a worker, breaking
+    # timestamp ties in (timestamp, message_id) keyset order
+    message_id: str = Field(default_factory=lambda: str(ObjectId()))
     user_id: str
     session_id: str
     role: str  # "user" or "assistant"
@@ -120,150 +285,1376 @@ class ChatResponse(BaseModel):
     feedback: Optional[str] = None
     score: Optional[int] = None
 
+class BatchRequestItem(BaseModel):
+    method: str = "GET"
+    path: str
+    body: Optional[Any] = None
+
+class BatchRequest(BaseModel):
+    requests: List[BatchRequestItem] = Field(..., min_length=1, max_length=BATCH_MAX_REQUESTS)
+
+class SyncRequest(BaseModel):
+    watermarks: Dict[str, Optional[str]] = {}
+    limit: int = Field(SYNC_BATCH_MAX, ge=1, le=SYNC_BATCH_MAX)
+
 # ========================
-# AUTH HELPERS
+# METRICS
 # ========================
 
-async def get_session_token_from_request(request: Request) -> Optional[str]:
-    """Extract session token from cookies or Authorization header"""
-    # Try cookies first
-    session_token = request.cookies.get("session_token")
-    if session_token:
-        return session_token
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+def escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+class Metric:
+    """Counter or gauge with a fixed set of label names, in Prometheus text format.
     
-    # Try Authorization header
-    auth_header = request.headers.get("Authorization")
-    if auth_header and auth_header.startswith("Bearer "):
-        return auth_header.replace("Bearer ", "")
+    Updates take a lock because PyMongo reports commands from Motor's worker
+    threads; an uncontended lock keeps the per-request cost in microseconds.
+    """
+
+    def __init__(self, name: str, help_text: str, metric_type: str, label_names: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple, amount: float = 1):
+        self.inc(labels, -amount)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(dict(zip(self.label_names, labels)))} {value}")
+        return lines
+
+class Histogram:
+    """Prometheus histogram; buckets are counted individually and summed on render"""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[tuple, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        # Index len(buckets) is the +Inf bucket; the last slot holds the sum
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = [(labels, list(series)) for labels, series in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, series in snapshot:
+            base = dict(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(bounds, series[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels({**base, 'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(base)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(base)} {cumulative}")
+        return lines
+
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route template.", ("method", "route"))
+http_requests_total = Metric("http_requests_total", "HTTP responses by route template and status.", "counter", ("method", "route", "status"))
+http_requests_in_flight = Metric("http_requests_in_flight", "HTTP requests currently being served.", "gauge", ("method", "route"))
+mongo_command_duration = Histogram("mongodb_command_duration_seconds", "MongoDB command latency by collection and command.", ("collection", "command"), MONGO_BUCKETS)
+mongo_command_failures = Metric("mongodb_command_failures_total", "Failed MongoDB commands by collection and command.", "counter", ("collection", "command"))
+llm_request_duration = Histogram("llm_request_duration_seconds", "LLM call duration by scenario, including streamed replies.", ("scenario",))
+llm_time_to_first_token = Histogram("llm_time_to_first_token_seconds", "Time to the first streamed LLM chunk by scenario.", ("scenario",))
+llm_errors_total = Metric("llm_errors_total", "Failed LLM calls by scenario.", "counter", ("scenario",))
+llm_tokens_total = Metric("llm_tokens_total", "LLM tokens by scenario and kind (prompt, cached, completion).", "counter", ("scenario", "kind"))
+
+REQUEST_METRICS = [http_request_duration, http_requests_total, http_requests_in_flight]
+MONGO_METRICS = [mongo_command_duration, mongo_command_failures]
+LLM_METRICS = [llm_request_duration, llm_time_to_first_token, llm_errors_total, llm_tokens_total]
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command by collection and command name.
     
-    return None
+    Only the started event carries the command document, so its collection
+    is kept per request_id until the succeeded or failed event arrives with
+    the server-measured duration.
+    """
 
-async def get_current_user(request: Request) -> Optional[User]:
-    """Get current authenticated user"""
-    session_token = await get_session_token_from_request(request)
-    if not session_token:
-        return None
+    def __init__(self):
+        self._collections: Dict[int, str] = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if not isinstance(target, str):
+            # getMore names its collection separately; admin commands have none
+            target = event.command.get("collection")
+        self._collections[event.request_id] = target if isinstance(target, str) else ""
+
+    def succeeded(self, event):
+        self._observe(event, failed=False)
+
+    def failed(self, event):
+        self._observe(event, failed=True)
+
+    def _observe(self, event, failed: bool):
+        labels = (self._collections.pop(event.request_id, ""), event.command_name)
+        mongo_command_duration.observe(labels, event.duration_micros / 1_000_000)
+        if failed:
+            mongo_command_failures.inc(labels)
+
+_static_route_templates: Dict[str, str] = {}
+
+def route_template(scope) -> str:
+    """Route template for a request (/api/combat/history/{session_id}).
     
-    session = await db.user_sessions.find_one(
-        {"session_token": session_token},
-        {"_id": 0}
-    )
+    Templates keep metric label sets bounded. Those of parameterless paths
+    are cached, so most requests skip route matching entirely.
+    """
+    path = scope["path"]
+    template = _static_route_templates.get(path)
+    if template is not None:
+        return template
     
-    if not session:
+    partial = None
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            if not route.param_convertors:
+                _static_route_templates[path] = route.path
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording latency, in-flight requests and status per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        labels = (scope["method"], route_template(scope))
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        http_requests_in_flight.inc(labels)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_request_duration.observe(labels, time.perf_counter() - started)
+            http_requests_total.inc(labels + (str(status),))
+            http_requests_in_flight.dec(labels)
+
+mongo_command_metrics = MongoCommandMetrics()
+
+# ========================
+# PROFILING
+# ========================
+
+class Profile:
+    """Sampled stacks in folded format ("frame;frame;frame count"), as read by
+    flamegraph.pl, speedscope and inferno"""
+
+    def __init__(self, label: str, per_request: bool):
+        self.profile_id = uuid.uuid4().hex[:12]
+        self.label = label
+        self.per_request = per_request
+        self.started_at = datetime.now(timezone.utc)
+        self.duration_seconds = 0.0
+        self.requests = 0
+        self.samples: Dict[str, int] = {}
+        self._started = time.perf_counter()
+
+    def add_sample(self, stack: str):
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def finish(self):
+        self.duration_seconds = time.perf_counter() - self._started
+
+    def folded(self) -> str:
+        samples = dict(self.samples)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "profile_id": self.profile_id,
+            "label": self.label,
+            "started_at": self.started_at,
+            "duration_seconds": self.duration_seconds,
+            "requests": self.requests,
+            "samples": sum(dict(self.samples).values())
+        }
+
+class ProfiledTask:
+    """A request task being sampled, and the Mongo command it is waiting on"""
+
+    def __init__(self, profile: Profile, task: asyncio.Task):
+        self.profile = profile
+        self.task = task
+        self.mongo_command: Optional[str] = None
+
+# Set for profiled requests; Motor copies the context into its worker
+# threads, so the Mongo command listener can see which request it serves
+profiled_task: contextvars.ContextVar[Optional[ProfiledTask]] = contextvars.ContextVar("profiled_task", default=None)
+
+def short_filename(filename: str) -> str:
+    """Package-relative path for installed modules, the bare name otherwise"""
+    short = filename.rsplit("site-packages/", 1)[-1]
+    return Path(filename).name if short == filename else short
+
+_frame_labels: Dict[Any, str] = {}
+
+def frame_label(code) -> str:
+    label = _frame_labels.get(code)
+    if label is None:
+        label = f"{code.co_name} ({short_filename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+        _frame_labels[code] = label
+    return label
+
+def sample_task_stack(target: ProfiledTask, thread_frame) -> Optional[str]:
+    """Folded stack for one task: its coroutine chain, then either the
+    synchronous frames it is running or what it is awaiting.
+    
+    A suspended coroutine is not on any thread stack, so the chain is
+    followed through cr_await instead; that is what makes await time in
+    Motor and httpx visible. Runs on the sampler thread, so a task caught
+    mid-switch can yield a partial stack.
+    """
+    frames = []
+    awaited = target.task.get_coro()
+    while awaited is not None:
+        frame = getattr(awaited, "cr_frame", None) or getattr(awaited, "gi_frame", None) or getattr(awaited, "ag_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        awaited = getattr(awaited, "cr_await", None) or getattr(awaited, "gi_yieldfrom", None) or getattr(awaited, "ag_await", None)
+    if not frames:
         return None
     
-    # Check expiry with timezone awareness
-    expires_at = session["expires_at"]
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    labels = [frame_label(frame.f_code) for frame in frames]
     
-    if expires_at < datetime.now(timezone.utc):
-        return None
+    # Running: the innermost coroutine frame is on the loop thread's stack
+    running = []
+    frame = thread_frame
+    while frame is not None and frame is not frames[-1]:
+        running.append(frame)
+        frame = frame.f_back
+    if frame is not None:
+        labels += [frame_label(f.f_code) for f in reversed(running)]
+    elif target.mongo_command:
+        labels.append(f"[motor] {target.mongo_command}")
+    elif awaited is not None:
+        labels.append(f"[await] {type(awaited).__name__}")
+    return ";".join(labels)
+
+class AsyncStackSampler:
+    """Background thread sampling the profiled tasks every PROFILER_INTERVAL_SECONDS.
     
-    user_doc = await db.users.find_one(
-        {"user_id": session["user_id"]},
-        {"_id": 0}
-    )
+    The thread only exists while something is being profiled.
+    """
+
+    def __init__(self):
+        self._targets: Dict[int, ProfiledTask] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._loop_thread_id: Optional[int] = None
+
+    def add(self, target: ProfiledTask):
+        with self._lock:
+            self._loop_thread_id = threading.get_ident()
+            self._targets[id(target)] = target
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+                self._thread.start()
+
+    def remove(self, target: ProfiledTask):
+        with self._lock:
+            self._targets.pop(id(target), None)
+
+    def _run(self):
+        while True:
+            time.sleep(PROFILER_INTERVAL_SECONDS)
+            with self._lock:
+                targets = list(self._targets.values())
+                if not targets:
+                    self._thread = None
+                    return
+            thread_frame = sys._current_frames().get(self._loop_thread_id)
+            for target in targets:
+                try:
+                    stack = sample_task_stack(target, thread_frame)
+                except Exception:
+                    continue
+                if stack:
+                    target.profile.add_sample(stack)
+
+async_stack_sampler = AsyncStackSampler()
+
+class RequestProfiler:
+    """Decides which requests to profile and keeps the finished profiles.
     
-    if user_doc:
-        return User(**user_doc)
-    return None
+    Unprofiled requests cost one attribute check when no window is open and
+    no PROFILER_TOKEN is configured, plus a header scan when one is.
+    """
 
-async def require_auth(request: Request) -> User:
-    """Dependency that requires authentication"""
-    user = await get_current_user(request)
-    if not user:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    return user
+    def __init__(self):
+        self.window: Optional[Profile] = None
+        self.window_ends_at = 0.0
+        self.window_path_prefix = ""
+        self.profiles: "OrderedDict[str, Profile]" = OrderedDict()
+
+    def profile_for(self, scope) -> Optional[Profile]:
+        if self.window is not None:
+            self.expire_window()
+            if self.window is not None and scope["path"].startswith(self.window_path_prefix):
+                return self.window
+        
+        if PROFILER_TOKEN:
+            for name, value in scope["headers"]:
+                if name == b"x-profile-request" and hmac.compare_digest(value, PROFILER_TOKEN.encode()):
+                    return Profile(f"{scope['method']} {scope['path']}", per_request=True)
+        return None
+
+    def start_window(self, seconds: float, path_prefix: str) -> Profile:
+        self.stop_window()
+        self.window = Profile(f"window {path_prefix or '/'} {seconds:g}s", per_request=False)
+        self.window_ends_at = time.monotonic() + seconds
+        self.window_path_prefix = path_prefix
+        return self.window
+
+    def expire_window(self):
+        if self.window is not None and time.monotonic() >= self.window_ends_at:
+            self.stop_window()
+
+    def stop_window(self) -> Optional[Profile]:
+        window, self.window = self.window, None
+        if window is not None:
+            self.store(window)
+        return window
+
+    def store(self, profile: Profile):
+        profile.finish()
+        self.profiles[profile.profile_id] = profile
+        while len(self.profiles) > PROFILER_MAX_PROFILES:
+            self.profiles.popitem(last=False)
+        if PROFILER_OUTPUT_DIR:
+            try:
+                path = Path(PROFILER_OUTPUT_DIR) / f"{profile.profile_id}.folded"
+                path.write_text(profile.folded())
+            except OSError as e:
+                logger.error(f"Could not save profile {profile.profile_id}: {e}")
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        if self.window is not None and self.window.profile_id == profile_id:
+            return self.window
+        return self.profiles.get(profile_id)
+
+request_profiler = RequestProfiler()
+
+class ProfilerMiddleware:
+    """ASGI middleware sampling the requests RequestProfiler selects.
+    
+    Profiled responses carry an X-Profile-Id header; the folded stacks are
+    served by /admin/profiles/{profile_id}. Streaming bodies run in a child
+    task and show up as the parent's await.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        profile = request_profiler.profile_for(scope)
+        if profile is None:
+            await self.app(scope, receive, send)
+            return
+        
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile.profile_id.encode())]
+            await send(message)
+        
+        profile.requests += 1
+        target = ProfiledTask(profile, asyncio.current_task())
+        token = profiled_task.set(target)
+        async_stack_sampler.add(target)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            async_stack_sampler.remove(target)
+            profiled_task.reset(token)
+            if profile.per_request:
+                request_profiler.store(profile)
+
+class MongoProfilerListener(monitoring.CommandListener):
+    """Tells the sampler which Mongo command a profiled request is waiting on"""
+
+    def started(self, event):
+        target = profiled_task.get()
+        if target is not None:
+            collection = event.command.get(event.command_name)
+            target.mongo_command = f"{event.command_name} {collection}" if isinstance(collection, str) else event.command_name
+
+    def succeeded(self, event):
+        target = profiled_task.get()
+        if target is not None:
+            target.mongo_command = None
+
+    def failed(self, event):
+        self.succeeded(event)
+
+# MongoDB connection
+client = AsyncIOMotorClient(
+    mongo_url,
+    event_listeners=([mongo_command_metrics] if METRICS_ENABLED else []) + [MongoProfilerListener()]
+)
+db = client[os.environ['DB_NAME']]
 
 # ========================
-# QUIZ DATA
+# MEMORY ACCOUNTING
 # ========================
 
-QUIZ_QUESTIONS = [
-    {
-        "id": 1,
-        "question": "When you walk into a room full of strangers, you typically...",
-        "options": [
-            {"value": "A", "text": "Scan for familiar faces and stick to corners"},
-            {"value": "B", "text": "Find one person to talk to deeply"},
-            {"value": "C", "text": "Work the room and meet everyone"},
-            {"value": "D", "text": "Wait for others to approach you"}
-        ]
-    },
-    {
-        "id": 2,
-        "question": "Your ideal first date would be...",
-        "options": [
-            {"value": "A", "text": "Coffee shop with deep conversation"},
-            {"value": "B", "text": "Adventure activity like hiking or go-karting"},
-            {"value": "C", "text": "Upscale dinner at a nice restaurant"},
-            {"value": "D", "text": "Casual walk in the park"}
-        ]
-    },
-    {
-        "id": 3,
-        "question": "When faced with rejection, you...",
-        "options": [
-            {"value": "A", "text": "Analyze what went wrong obsessively"},
-            {"value": "B", "text": "Move on quickly to the next opportunity"},
-            {"value": "C", "text": "Take time to process but stay resilient"},
-            {"value": "D", "text": "Avoid similar situations in the future"}
-        ]
-    },
-    {
-        "id": 4,
-        "question": "Your communication style is best described as...",
-        "options": [
-            {"value": "A", "text": "Thoughtful and measured"},
-            {"value": "B", "text": "Energetic and expressive"},
-            {"value": "C", "text": "Direct and confident"},
-            {"value": "D", "text": "Supportive and empathetic"}
-        ]
-    },
-    {
-        "id": 5,
-        "question": "What do you value most in a potential partner?",
-        "options": [
-            {"value": "A", "text": "Intelligence and deep conversations"},
-            {"value": "B", "text": "Shared sense of adventure"},
-            {"value": "C", "text": "Ambition and success"},
-            {"value": "D", "text": "Kindness and emotional connection"}
-        ]
-    },
-    {
-        "id": 6,
-        "question": "When it comes to physical appearance, you...",
-        "options": [
-            {"value": "A", "text": "Focus on being presentable but low-key"},
-            {"value": "B", "text": "Express yourself through unique style"},
-            {"value": "C", "text": "Dress to impress and stand out"},
-            {"value": "D", "text": "Prioritize comfort over fashion"}
+# Allocations made by tracemalloc itself and the import machinery are noise
+MEMORY_SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+# "module" groups by file, "line" by file and line, "traceback" by the whole
+# stack (needs MEMORY_TRACE_FRAMES > 1 to say more than "line")
+MEMORY_GROUPINGS = {"module": "filename", "line": "lineno", "traceback": "traceback"}
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def memory_stat_location(stat, group_by: str) -> str:
+    frame = stat.traceback[0]
+    if group_by == "module":
+        return short_filename(frame.filename)
+    if group_by == "line":
+        return f"{short_filename(frame.filename)}:{frame.lineno}"
+    return " <- ".join(f"{short_filename(f.filename)}:{f.lineno}" for f in stat.traceback)
+
+class MemoryAccounting:
+    """tracemalloc heap snapshots plus sampled memory use per route.
+    
+    During a route window one sampled request at a time is measured: the
+    traced peak above its starting point (what it allocated at most) and the
+    traced size it left behind (what it retained). Other requests running
+    at the same time are counted in too, so compare routes across many
+    samples rather than trusting a single one.
+    """
+
+    def __init__(self):
+        self.snapshots: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.routes: Dict[tuple, Dict[str, int]] = {}
+        self.window_started_at: Optional[datetime] = None
+        self.window_ends_at: Optional[float] = None
+        self.sample_rate = 0.0
+        self._sampling = False
+        self._rng = random.Random()
+
+    def start_tracing(self, frames: int):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop_tracing(self):
+        self.window_ends_at = None
+        tracemalloc.stop()
+
+    def status(self) -> Dict[str, Any]:
+        traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "frames": tracemalloc.get_traceback_limit(),
+            "traced_bytes": traced,
+            "peak_bytes": peak,
+            "tracemalloc_overhead_bytes": tracemalloc.get_tracemalloc_memory(),
+            "rss_bytes": rss_bytes(),
+            "snapshots": [self.snapshot_summary(entry) for entry in self.snapshots.values()],
+            "route_window": self.window_summary()
+        }
+
+    def take_snapshot(self) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing():
+            raise HTTPException(status_code=409, detail="tracemalloc is not tracing; start it first")
+        
+        traced, peak = tracemalloc.get_traced_memory()
+        entry = {
+            "snapshot_id": uuid.uuid4().hex[:12],
+            "taken_at": datetime.now(timezone.utc),
+            "traced_bytes": traced,
+            "peak_bytes": peak,
+            "rss_bytes": rss_bytes(),
+            "snapshot": tracemalloc.take_snapshot().filter_traces(MEMORY_SNAPSHOT_FILTERS)
+        }
+        self.snapshots[entry["snapshot_id"]] = entry
+        while len(self.snapshots) > MEMORY_MAX_SNAPSHOTS:
+            self.snapshots.popitem(last=False)
+        return entry
+
+    def get_snapshot(self, snapshot_id: str) -> Dict[str, Any]:
+        entry = self.snapshots.get(snapshot_id)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Snapshot not found")
+        return entry
+
+    @staticmethod
+    def snapshot_summary(entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in entry.items() if key != "snapshot"}
+
+    def top(self, snapshot_id: str, group_by: str, limit: int) -> List[Dict[str, Any]]:
+        stats = self.get_snapshot(snapshot_id)["snapshot"].statistics(MEMORY_GROUPINGS[group_by])
+        return [
+            {"location": memory_stat_location(stat, group_by), "size_bytes": stat.size, "count": stat.count}
+            for stat in stats[:limit]
         ]
-    },
-    {
-        "id": 7,
-        "question": "In group conversations, you usually...",
-        "options": [
-            {"value": "A", "text": "Listen more than you speak"},
-            {"value": "B", "text": "Tell stories and entertain"},
-            {"value": "C", "text": "Lead discussions and share opinions"},
-            {"value": "D", "text": "Support others' points and ask questions"}
+
+    def diff(self, snapshot_id: str, base_id: str, group_by: str, limit: int) -> List[Dict[str, Any]]:
+        current = self.get_snapshot(snapshot_id)["snapshot"]
+        base = self.get_snapshot(base_id)["snapshot"]
+        stats = current.compare_to(base, MEMORY_GROUPINGS[group_by])
+        return [
+            {
+                "location": memory_stat_location(stat, group_by),
+                "size_diff_bytes": stat.size_diff,
+                "size_bytes": stat.size,
+                "count_diff": stat.count_diff,
+                "count": stat.count
+            }
+            for stat in stats[:limit]
         ]
-    },
-    {
-        "id": 8,
-        "question": "Your approach to self-improvement is...",
-        "options": [
-            {"value": "A", "text": "Reading and absorbing information"},
-            {"value": "B", "text": "Trial and error through experience"},
-            {"value": "C", "text": "Setting goals and working systematically"},
-            {"value": "D", "text": "Working with mentors or coaches"}
+
+    def start_window(self, seconds: float, sample_rate: float):
+        self.start_tracing(MEMORY_TRACE_FRAMES)
+        self.routes = {}
+        self.sample_rate = sample_rate
+        self.window_started_at = datetime.now(timezone.utc)
+        self.window_ends_at = time.monotonic() + seconds
+
+    def should_sample(self) -> bool:
+        if self.window_ends_at is None or self._sampling:
+            return False
+        if time.monotonic() >= self.window_ends_at or not tracemalloc.is_tracing():
+            self.window_ends_at = None
+            return False
+        return self._rng.random() < self.sample_rate
+
+    def begin_sample(self) -> int:
+        self._sampling = True
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def end_sample(self, labels: tuple, start_bytes: int):
+        self._sampling = False
+        if not tracemalloc.is_tracing():
+            return
+        traced, peak = tracemalloc.get_traced_memory()
+        stats = self.routes.setdefault(labels, {"requests": 0, "allocated_bytes": 0, "max_allocated_bytes": 0, "retained_bytes": 0})
+        stats["requests"] += 1
+        stats["allocated_bytes"] += peak - start_bytes
+        stats["max_allocated_bytes"] = max(stats["max_allocated_bytes"], peak - start_bytes)
+        stats["retained_bytes"] += traced - start_bytes
+
+    def window_summary(self) -> Optional[Dict[str, Any]]:
+        if self.window_started_at is None:
+            return None
+        routes = [
+            {
+                "method": method,
+                "route": route,
+                **stats,
+                "avg_allocated_bytes": stats["allocated_bytes"] // stats["requests"],
+                "avg_retained_bytes": stats["retained_bytes"] // stats["requests"]
+            }
+            for (method, route), stats in self.routes.items()
         ]
-    },
-    {
-        "id": 9,
-        "question": "When texting someone you're interested in...",
+        routes.sort(key=lambda route: route["allocated_bytes"], reverse=True)
+        return {
+            "started_at": self.window_started_at,
+            "active": self.window_ends_at is not None and time.monotonic() < self.window_ends_at,
+            "sample_rate": self.sample_rate,
+            "routes": routes
+        }
+
+memory_accounting = MemoryAccounting()
+
+class MemoryAccountingMiddleware:
+    """ASGI middleware measuring sampled requests during a route window"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not memory_accounting.should_sample():
+            await self.app(scope, receive, send)
+            return
+        
+        labels = (scope["method"], route_template(scope))
+        start_bytes = memory_accounting.begin_sample()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            memory_accounting.end_sample(labels, start_bytes)
+
+# ========================
+# HTTP CLIENT POOLS
+# ========================
+
+class PooledHttpClient:
+    """App-lifetime httpx.AsyncClient that counts connection reuse.
+
+    httpcore reports a connect_tcp/start_tls trace event only when it opens a
+    new connection, so requests sent minus new connections is the reuse count.
+    """
+
+    def __init__(self, name: str, timeout_seconds: float):
+        self.name = name
+        self.timeout_seconds = timeout_seconds
+        self.client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.sent_requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+    def open(self) -> httpx.AsyncClient:
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_POOL_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(self.timeout_seconds, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            event_hooks={"request": [self._on_request]}
+        )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _on_request(self, request: httpx.Request):
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event_name: str, info: Dict[str, Any]):
+        if event_name.endswith(".send_request_headers.started"):
+            self.sent_requests += 1
+        elif event_name == "connection.connect_tcp.complete":
+            self.new_connections += 1
+        elif event_name == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+
+    def stats(self) -> Dict[str, Any]:
+        reused = max(self.sent_requests - self.new_connections, 0)
+        return {
+            "requests": self.requests,
+            "sent_requests": self.sent_requests,
+            "new_connections": self.new_connections,
+            "tls_handshakes": self.tls_handshakes,
+            "reused_connections": reused,
+            "reuse_rate": reused / self.sent_requests if self.sent_requests else 0.0
+        }
+
+auth_http = PooledHttpClient("auth", AUTH_HTTP_TIMEOUT_SECONDS)
+llm_http = PooledHttpClient("llm", LLM_HTTP_TIMEOUT_SECONDS)
+
+def install_llm_http_client(http_client: Optional[httpx.AsyncClient]):
+    """Route LlmChat's OpenAI calls through the shared pool.
+    
+    LlmChat keeps per-session message state, so instances are still built
+    per turn; litellm underneath reuses litellm.aclient_session when set.
+    """
+    try:
+        import litellm
+    except ImportError:
+        if http_client is not None:
+            logger.warning("litellm not available; LLM calls use their own HTTP clients")
+        return
+    litellm.aclient_session = http_client
+
+# ========================
+# DATABASE INDEXES
+# ========================
+
+# (collection, keys, options) for every index the hot queries rely on
+REQUIRED_INDEXES = [
+    ("user_sessions", [("session_token", ASCENDING)], {"name": "session_token_1"}),
+    ("user_sessions", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("users", [("email", ASCENDING)], {"name": "email_1"}),
+    ("users", [("user_id", ASCENDING)], {"name": "user_id_1"}),
+    ("user_progress", [("user_id", ASCENDING)], {"name": "user_id_1"}),
+    ("quiz_results", [("user_id", ASCENDING)], {"name": "user_id_1"}),
+    ("journal_entries", [("user_id", ASCENDING), ("timestamp", DESCENDING), ("entry_id", DESCENDING)], {"name": "user_id_1_timestamp_-1_entry_id_-1"}),
+    ("journal_entries", [("user_id", ASCENDING), ("idempotency_key", ASCENDING)], {"name": "user_id_1_idempotency_key_1", "unique": True, "partialFilterExpression": {"idempotency_key": {"$type": "string"}}}),
+    ("chat_messages", [("user_id", ASCENDING), ("session_id", ASCENDING), ("timestamp", ASCENDING), ("message_id", ASCENDING)], {"name": "user_id_1_session_id_1_timestamp_1_message_id_1"}),
+    ("chat_messages", [("user_id", ASCENDING), ("timestamp", ASCENDING), ("message_id", ASCENDING)], {"name": "user_id_1_timestamp_1_message_id_1"}),
+    ("chat_sessions", [("user_id", ASCENDING), ("session_id", ASCENDING)], {"name": "user_id_1_session_id_1", "unique": True}),
+    ("llm_response_cache", [("key", ASCENDING)], {"name": "key_1", "unique": True}),
+    ("llm_response_cache", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("revoked_tokens", [("jti", ASCENDING)], {"name": "jti_1"}),
+    ("revoked_tokens", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+]
+
+# IndexOptionsConflict, IndexKeySpecsConflict, IndexAlreadyExists
+INDEX_CONFLICT_CODES = {85, 86, 68}
+
+async def ensure_indexes():
+    """Create the required indexes, logging or failing on conflicts"""
+    conflicts = []
+    for collection, keys, options in REQUIRED_INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            if e.code not in INDEX_CONFLICT_CODES:
+                raise
+            conflicts.append(f"{collection}.{options['name']}: {e.details.get('errmsg', e)}")
+    
+    for conflict in conflicts:
+        logger.error(f"Index conflict on {conflict}")
+    
+    if conflicts and INDEX_CONFLICT_POLICY == "fail":
+        raise RuntimeError(f"{len(conflicts)} index conflict(s); see log for details")
+
+# (name, collection, filter, sort) for each hot query, with probe values
+HOT_QUERIES = [
+    ("session lookup", "user_sessions", {"session_token": "explain"}, None),
+    ("user by email", "users", {"email": "explain"}, None),
+    ("user by id", "users", {"user_id": "explain"}, None),
+    ("progress by user", "user_progress", {"user_id": "explain"}, None),
+    ("quiz result by user", "quiz_results", {"user_id": "explain"}, None),
+    ("journal entries", "journal_entries", {"user_id": "explain"}, [("timestamp", DESCENDING), ("entry_id", DESCENDING)]),
+    ("chat history", "chat_messages", {"user_id": "explain", "session_id": "explain"}, [("timestamp", ASCENDING), ("message_id", ASCENDING)]),
+    ("chat sync", "chat_messages", {"user_id": "explain"}, [("timestamp", ASCENDING), ("message_id", ASCENDING)]),
+]
+
+def find_plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Collect every stage name in an explain() query plan"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += find_plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += find_plan_stages(child)
+    return stages
+
+async def explain_hot_queries() -> bool:
+    """Print the winning plan of each hot query; return False on any COLLSCAN"""
+    all_indexed = True
+    for name, collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        stages = find_plan_stages(winning_plan)
+        
+        status = "OK"
+        if "COLLSCAN" in stages:
+            status = "COLLSCAN"
+            all_indexed = False
+        print(f"[{status}] {name} ({collection}): {' <- '.join(stages)}")
+        print(json.dumps(winning_plan, indent=2, default=str))
+    return all_indexed
+
+# ========================
+# XP EVENT BUFFER
+# ========================
+
+class XpEventBuffer:
+    """Merges XP deltas and last_activity per user and writes them together.
+    
+    Pending deltas are flushed as one bulk_write once XP_FLUSH_MAX_USERS
+    users are waiting or every XP_FLUSH_INTERVAL_SECONDS, and on shutdown.
+    Deltas whose update failed are put back so they go out with the next
+    flush; updates the database applied are never sent twice.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._pending_events = 0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = asyncio.Event()
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        self._closing.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the flush loop without interrupting a flush in progress, then
+        write whatever is still pending"""
+        self._closing.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        if self._flush_task is not None:
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+
+    def add(self, user_id: str, xp: int, activity_at: datetime):
+        self._merge(user_id, xp, activity_at, 1)
+        if len(self._pending) >= XP_FLUSH_MAX_USERS and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def pending_xp(self, user_id: str) -> int:
+        pending = self._pending.get(user_id)
+        return pending["xp"] if pending else 0
+
+    def _merge(self, user_id: str, xp: int, activity_at: datetime, events: int):
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self._pending[user_id] = {"xp": xp, "activity_at": activity_at, "events": events}
+        else:
+            pending["xp"] += xp
+            pending["activity_at"] = max(pending["activity_at"], activity_at)
+            pending["events"] += events
+        self._pending_events += events
+
+    async def _run(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), timeout=XP_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            events, self._pending_events = self._pending_events, 0
+            
+            started = time.perf_counter()
+            flushed_at = datetime.now(timezone.utc)
+            users = list(batch)
+            try:
+                await db.user_progress.bulk_write([
+                    UpdateOne(
+                        {"user_id": user_id},
+                        {
+                            "$inc": {"xp": batch[user_id]["xp"]},
+                            "$set": {"last_activity": batch[user_id]["activity_at"], "updated_at": flushed_at}
+                        }
+                    )
+                    for user_id in users
+                ], ordered=False)
+            except BulkWriteError as e:
+                # Unordered: every update without a write error was applied
+                failed = [users[error["index"]] for error in e.details.get("writeErrors", [])]
+                self.flushed_events += events - sum(batch[user_id]["events"] for user_id in failed)
+                self._requeue(batch, failed, e)
+                return
+            except Exception as e:
+                self._requeue(batch, users, e)
+                return
+            
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.flushed_events += events
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+
+    def _requeue(self, batch: Dict[str, Dict[str, Any]], users: List[str], error: Exception):
+        self.failed_flushes += 1
+        logger.error(f"XP flush failed for {len(users)} of {len(batch)} users: {error}")
+        for user_id in users:
+            pending = batch[user_id]
+            self._merge(user_id, pending["xp"], pending["activity_at"], pending["events"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": XP_BUFFER_ENABLED,
+            "queue_depth": len(self._pending),
+            "pending_events": self._pending_events,
+            "flushes": self.flushes,
+            "flushed_events": self.flushed_events,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+            "avg_flush_ms": self.total_flush_ms / self.flushes if self.flushes else 0.0
+        }
+
+xp_buffer = XpEventBuffer()
+
+async def award_xp(user_id: str, xp: int):
+    """Add XP and bump last_activity, through the buffer when it is enabled"""
+    now = datetime.now(timezone.utc)
+    if XP_BUFFER_ENABLED:
+        xp_buffer.add(user_id, xp, now)
+        return
+    
+    await db.user_progress.update_one(
+        {"user_id": user_id},
+        {
+            "$inc": {"xp": xp},
+            "$set": {"last_activity": now, "updated_at": now}
+        }
+    )
+
+# ========================
+# PAGINATION HELPERS
+# ========================
+
+PAGE_SIZE_MAX = 100
+
+def keyset_key(doc: Dict[str, Any], id_field: str, timestamp_field: str = "timestamp") -> tuple:
+    """A document's (timestamp, id) position as Mongo stores and sorts it"""
+    timestamp = doc[timestamp_field]
+    # Mongo keeps naive UTC at millisecond precision, so positions must match that
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000, tzinfo=None), doc[id_field]
+
+def encode_cursor(doc: Dict[str, Any], id_field: str, timestamp_field: str = "timestamp") -> str:
+    """Opaque keyset cursor for a document's (timestamp, id) position"""
+    timestamp, doc_id = keyset_key(doc, id_field, timestamp_field)
+    raw = json.dumps([timestamp.isoformat(), doc_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, doc_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc), doc_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_fields(fields: Optional[str], allowed: List[str], required: List[str]) -> Dict[str, Any]:
+    """Mongo projection for a comma-separated list-view field selection"""
+    if not fields:
+        return {"_id": 0}
+    
+    selected = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in selected if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    
+    projection = {"_id": 0}
+    for field in required + selected:
+        projection[field] = 1
+    return projection
+
+def apply_projection(doc: Dict[str, Any], projection: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a Mongo inclusion or exclusion projection to an in-memory document"""
+    included = [field for field, value in projection.items() if value and field != "_id"]
+    if included:
+        return {field: doc[field] for field in included if field in doc}
+    return {field: value for field, value in doc.items() if projection.get(field, 1)}
+
+async def keyset_page(
+    collection,
+    query: Dict[str, Any],
+    id_field: str,
+    newest_first: bool,
+    before: Optional[str],
+    after: Optional[str],
+    limit: int,
+    projection: Dict[str, Any],
+    pending: Optional[List[Dict[str, Any]]] = None
+):
+    """Fetch one (timestamp, id) keyset page, merged with pending unwritten items"""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    
+    query = dict(query)
+    cursor_value = before or after
+    position = None
+    if cursor_value:
+        timestamp, doc_id = decode_cursor(cursor_value)
+        position = (timestamp.replace(tzinfo=None), doc_id)
+        op = "$lt" if before else "$gt"
+        query["$or"] = [
+            {"timestamp": {op: timestamp}},
+            {"timestamp": timestamp, id_field: {op: doc_id}}
+        ]
+    
+    # Walk towards older items for before (or a newest-first first page)
+    walk_older = bool(before) or (newest_first and not after)
+    direction = DESCENDING if walk_older else ASCENDING
+    items = await collection.find(query, projection).sort(
+        [("timestamp", direction), (id_field, direction)]
+    ).to_list(limit + 1)
+    
+    if pending:
+        # Writes still queued on this worker belong on every page they fall
+        # in, including pages whose cursor was taken from one of them
+        stored_ids = {item[id_field] for item in items}
+        for item in pending:
+            if item[id_field] in stored_ids:
+                continue
+            key = keyset_key(item, id_field)
+            if position is not None and not (key < position if before else key > position):
+                continue
+            items.append(apply_projection(item, projection))
+        items.sort(key=lambda item: keyset_key(item, id_field), reverse=walk_older)
+    
+    has_more = len(items) > limit
+    items = items[:limit]
+    next_cursor = encode_cursor(items[-1], id_field) if has_more else None
+    
+    if walk_older != newest_first:
+        items.reverse()
+    return items, next_cursor
+
+# ========================
+# AUTH HELPERS
+# ========================
+
+async def get_session_token_from_request(request: HTTPConnection) -> Optional[str]:
+    """Extract session token from cookies or Authorization header"""
+    # Try cookies first
+    session_token = request.cookies.get("session_token")
+    if session_token:
+        return session_token
+    
+    # Try Authorization header
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        return auth_header.replace("Bearer ", "")
+    
+    return None
+
+class SessionUserCache:
+    """Bounded LRU cache of session_token -> User with per-entry TTL.
+
+    Entries never outlive the session's own expires_at. The cache is local to
+    the worker, so a logout on another worker is only seen after the TTL.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_token: str) -> Optional[User]:
+        entry = self._entries.get(session_token)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        user, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[session_token]
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(session_token)
+        self.hits += 1
+        return user
+
+    def set(self, session_token: str, user: User, session_expires_at: datetime):
+        # Cap the TTL at the session expiry so expired sessions are never served
+        session_ttl = (session_expires_at - datetime.now(timezone.utc)).total_seconds()
+        ttl = min(self.ttl_seconds, session_ttl)
+        if ttl <= 0:
+            return
+        
+        self._entries[session_token] = (user, time.monotonic() + ttl)
+        self._entries.move_to_end(session_token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, session_token: str):
+        self._entries.pop(session_token, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": AUTH_CACHE_ENABLED,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+session_user_cache = SessionUserCache(AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL_SECONDS)
+
+class RevokedTokenDenylist:
+    """In-memory set of revoked signed-token ids, persisted in Mongo.
+
+    Each worker reloads the revoked_tokens collection periodically so a
+    logout on one worker is honoured by the others within the refresh interval.
+    """
+
+    def __init__(self):
+        self._revoked: Dict[str, datetime] = {}
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    async def revoke(self, jti: str, expires_at: datetime):
+        self._revoked[jti] = expires_at
+        await db.revoked_tokens.update_one(
+            {"jti": jti},
+            {"$set": {"jti": jti, "expires_at": expires_at}},
+            upsert=True
+        )
+
+    async def load(self):
+        now = datetime.now(timezone.utc)
+        revoked = {}
+        async for doc in db.revoked_tokens.find(
+            {"expires_at": {"$gt": now}},
+            {"_id": 0, "jti": 1, "expires_at": 1}
+        ):
+            revoked[doc["jti"]] = doc["expires_at"]
+        self._revoked = revoked
+
+revoked_tokens = RevokedTokenDenylist()
+
+def create_signed_token(user: Dict[str, Any], expires_at: datetime) -> str:
+    """Create an HMAC-signed session token carrying the user and its expiry"""
+    created_at = user["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    
+    payload = {
+        "sub": user["user_id"],
+        "email": user["email"],
+        "name": user["name"],
+        "picture": user.get("picture"),
+        "created_at": created_at.timestamp(),
+        "jti": uuid.uuid4().hex,
+        "iat": datetime.now(timezone.utc),
+        "exp": expires_at
+    }
+    return jwt.encode(payload, AUTH_TOKEN_SECRET, algorithm=AUTH_TOKEN_ALGORITHM)
+
+def is_signed_token(session_token: str) -> bool:
+    """Whether a token has the shape of a signed token, valid or not"""
+    if not AUTH_TOKEN_SECRET or session_token.count(".") != 2:
+        return False
+    try:
+        jwt.get_unverified_header(session_token)
+    except jwt.PyJWTError:
+        return False
+    return True
+
+def decode_signed_token(session_token: str) -> Optional[Dict[str, Any]]:
+    """Verify a signed session token, returning its payload or None"""
+    if not is_signed_token(session_token):
+        return None
+    try:
+        return jwt.decode(session_token, AUTH_TOKEN_SECRET, algorithms=[AUTH_TOKEN_ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+
+def get_user_from_signed_token(payload: Dict[str, Any]) -> Optional[User]:
+    """Get user from a verified token payload without touching the database"""
+    if payload["jti"] in revoked_tokens:
+        return None
+    return User(
+        user_id=payload["sub"],
+        email=payload["email"],
+        name=payload["name"],
+        picture=payload.get("picture"),
+        created_at=datetime.fromtimestamp(payload["created_at"], tz=timezone.utc)
+    )
+
+async def get_current_user(request: HTTPConnection) -> Optional[User]:
+    """Get current authenticated user"""
+    # Sub-requests of /batch reuse the user the batch itself authenticated
+    batch_user = request.scope.get("batch_user")
+    if batch_user is not None:
+        return batch_user
+    
+    session_token = await get_session_token_from_request(request)
+    if not session_token:
+        return None
+    
+    # Signed tokens are self-contained, and an expired or forged one is
+    # rejected without a database read; other tokens fall back to
+    # user_sessions so sessions issued before switching AUTH_MODE keep working
+    if is_signed_token(session_token):
+        payload = decode_signed_token(session_token)
+        return get_user_from_signed_token(payload) if payload is not None else None
+    
+    if AUTH_CACHE_ENABLED:
+        cached_user = session_user_cache.get(session_token)
+        if cached_user:
+            return cached_user
+    
+    session = await db.user_sessions.find_one(
+        {"session_token": session_token},
+        {"_id": 0}
+    )
+    
+    if not session:
+        return None
+    
+    # Check expiry with timezone awareness
+    expires_at = session["expires_at"]
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    
+    if expires_at < datetime.now(timezone.utc):
+        return None
+    
+    user_doc = await db.users.find_one(
+        {"user_id": session["user_id"]},
+        {"_id": 0}
+    )
+    
+    if user_doc:
+        user = User(**user_doc)
+        if AUTH_CACHE_ENABLED:
+            session_user_cache.set(session_token, user, expires_at)
+        return user
+    return None
+
+async def require_auth(request: Request) -> User:
+    """Dependency that requires authentication"""
+    user = await get_current_user(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return user
+
+# ========================
+# QUIZ DATA
+# ========================
+
+QUIZ_QUESTIONS = [
+    {
+        "id": 1,
+        "question": "When you walk into a room full of strangers, you typically...",
+        "options": [
+            {"value": "A", "text": "Scan for familiar faces and stick to corners"},
+            {"value": "B", "text": "Find one person to talk to deeply"},
+            {"value": "C", "text": "Work the room and meet everyone"},
+            {"value": "D", "text": "Wait for others to approach you"}
+        ]
+    },
+    {
+        "id": 2,
+        "question": "Your ideal first date would be...",
+        "options": [
+            {"value": "A", "text": "Coffee shop with deep conversation"},
+            {"value": "B", "text": "Adventure activity like hiking or go-karting"},
+            {"value": "C", "text": "Upscale dinner at a nice restaurant"},
+            {"value": "D", "text": "Casual walk in the park"}
+        ]
+    },
+    {
+        "id": 3,
+        "question": "When faced with rejection, you...",
+        "options": [
+            {"value": "A", "text": "Analyze what went wrong obsessively"},
+            {"value": "B", "text": "Move on quickly to the next opportunity"},
+            {"value": "C", "text": "Take time to process but stay resilient"},
+            {"value": "D", "text": "Avoid similar situations in the future"}
+        ]
+    },
+    {
+        "id": 4,
+        "question": "Your communication style is best described as...",
+        "options": [
+            {"value": "A", "text": "Thoughtful and measured"},
+            {"value": "B", "text": "Energetic and expressive"},
+            {"value": "C", "text": "Direct and confident"},
+            {"value": "D", "text": "Supportive and empathetic"}
+        ]
+    },
+    {
+        "id": 5,
+        "question": "What do you value most in a potential partner?",
+        "options": [
+            {"value": "A", "text": "Intelligence and deep conversations"},
+            {"value": "B", "text": "Shared sense of adventure"},
+            {"value": "C", "text": "Ambition and success"},
+            {"value": "D", "text": "Kindness and emotional connection"}
+        ]
+    },
+    {
+        "id": 6,
+        "question": "When it comes to physical appearance, you...",
+        "options": [
+            {"value": "A", "text": "Focus on being presentable but low-key"},
+            {"value": "B", "text": "Express yourself through unique style"},
+            {"value": "C", "text": "Dress to impress and stand out"},
+            {"value": "D", "text": "Prioritize comfort over fashion"}
+        ]
+    },
+    {
+        "id": 7,
+        "question": "In group conversations, you usually...",
+        "options": [
+            {"value": "A", "text": "Listen more than you speak"},
+            {"value": "B", "text": "Tell stories and entertain"},
+            {"value": "C", "text": "Lead discussions and share opinions"},
+            {"value": "D", "text": "Support others' points and ask questions"}
+        ]
+    },
+    {
+        "id": 8,
+        "question": "Your approach to self-improvement is...",
+        "options": [
+            {"value": "A", "text": "Reading and absorbing information"},
+            {"value": "B", "text": "Trial and error through experience"},
+            {"value": "C", "text": "Setting goals and working systematically"},
+            {"value": "D", "text": "Working with mentors or coaches"}
+        ]
+    },
+    {
+        "id": 9,
+        "question": "When texting someone you're interested in...",
         "options": [
             {"value": "A", "text": "Over-analyze every message before sending"},
             {"value": "B", "text": "Send spontaneous, fun messages"},
@@ -283,130 +1674,1536 @@ QUIZ_QUESTIONS = [
     }
 ]
 
-ARCHETYPES = {
-    "analytical": {
-        "title": "The Strategic Mind",
-        "description": "You approach dating with the same analytical mindset you apply to everything. Your strength lies in understanding dynamics and patterns, but you may overthink instead of taking action.",
-        "strengths": ["Deep thinking", "Pattern recognition", "Thoughtful conversations"],
-        "areas_to_improve": ["Taking spontaneous action", "Being present in the moment", "Expressing emotions freely"],
-        "recommended_modules": ["Foundation Protocol", "Conversation Combat"]
-    },
-    "adventurer": {
-        "title": "The Dynamic Explorer",
-        "description": "You bring energy and excitement to every interaction. Your spontaneity is attractive, but you may struggle with building deeper emotional connections.",
-        "strengths": ["High energy", "Spontaneity", "Fun to be around"],
-        "areas_to_improve": ["Active listening", "Emotional depth", "Patience in relationships"],
-        "recommended_modules": ["Foundation Protocol", "Conversation Combat"]
-    },
-    "alpha": {
-        "title": "The Natural Leader",
-        "description": "You exude confidence and know what you want. Your directness is attractive, but ensure you balance ambition with genuine emotional availability.",
-        "strengths": ["Confidence", "Clear direction", "Strong presence"],
-        "areas_to_improve": ["Vulnerability", "Emotional expression", "Active listening"],
-        "recommended_modules": ["Conversation Combat", "Foundation Protocol"]
-    },
-    "empath": {
-        "title": "The Genuine Connector",
-        "description": "You excel at creating emotional bonds and making others feel understood. Build your confidence to match your emotional intelligence.",
-        "strengths": ["Emotional intelligence", "Deep connections", "Supportive nature"],
-        "areas_to_improve": ["Self-confidence", "Setting boundaries", "Taking initiative"],
-        "recommended_modules": ["Foundation Protocol", "Conversation Combat"]
-    }
-}
+ARCHETYPES = {
+    "analytical": {
+        "title": "The Strategic Mind",
+        "description": "You approach dating with the same analytical mindset you apply to everything. Your strength lies in understanding dynamics and patterns, but you may overthink instead of taking action.",
+        "strengths": ["Deep thinking", "Pattern recognition", "Thoughtful conversations"],
+        "areas_to_improve": ["Taking spontaneous action", "Being present in the moment", "Expressing emotions freely"],
+        "recommended_modules": ["Foundation Protocol", "Conversation Combat"]
+    },
+    "adventurer": {
+        "title": "The Dynamic Explorer",
+        "description": "You bring energy and excitement to every interaction. Your spontaneity is attractive, but you may struggle with building deeper emotional connections.",
+        "strengths": ["High energy", "Spontaneity", "Fun to be around"],
+        "areas_to_improve": ["Active listening", "Emotional depth", "Patience in relationships"],
+        "recommended_modules": ["Foundation Protocol", "Conversation Combat"]
+    },
+    "alpha": {
+        "title": "The Natural Leader",
+        "description": "You exude confidence and know what you want. Your directness is attractive, but ensure you balance ambition with genuine emotional availability.",
+        "strengths": ["Confidence", "Clear direction", "Strong presence"],
+        "areas_to_improve": ["Vulnerability", "Emotional expression", "Active listening"],
+        "recommended_modules": ["Conversation Combat", "Foundation Protocol"]
+    },
+    "empath": {
+        "title": "The Genuine Connector",
+        "description": "You excel at creating emotional bonds and making others feel understood. Build your confidence to match your emotional intelligence.",
+        "strengths": ["Emotional intelligence", "Deep connections", "Supportive nature"],
+        "areas_to_improve": ["Self-confidence", "Setting boundaries", "Taking initiative"],
+        "recommended_modules": ["Foundation Protocol", "Conversation Combat"]
+    }
+}
+
+# ========================
+# QUIZ SCORING
+# ========================
+
+ARCHETYPE_KEYS = ["analytical", "adventurer", "alpha", "empath"]
+OPTION_VALUES = ["A", "B", "C", "D"]
+
+# Archetype each option letter counts towards by default
+ANSWER_ARCHETYPES = {
+    "A": "analytical",
+    "B": "adventurer",
+    "C": "alpha",
+    "D": "empath"
+}
+
+# answer_key characters for a question left unanswered and an unknown letter
+UNANSWERED_KEY = "-"
+UNKNOWN_OPTION_KEY = "?"
+
+class QuizScoringEngine:
+    """Scores quiz submissions against a (questions x options x archetypes) weight matrix"""
+
+    def __init__(self, weights: np.ndarray, question_ids: List[int]):
+        self.question_ids = question_ids
+        self.question_index = {question_id: i for i, question_id in enumerate(question_ids)}
+        self.option_index = {value: i for i, value in enumerate(OPTION_VALUES)}
+        
+        # Extra rows and columns: unknown question ids score by the default
+        # letter map, unknown letters count as analytical, unanswered as nothing
+        default_row = np.zeros((len(OPTION_VALUES) + 2, len(ARCHETYPE_KEYS)))
+        for option, archetype in ANSWER_ARCHETYPES.items():
+            default_row[self.option_index[option], ARCHETYPE_KEYS.index(archetype)] = 1
+        default_row[len(OPTION_VALUES), ARCHETYPE_KEYS.index("analytical")] = 1
+        
+        self.weights = np.tile(default_row, (len(question_ids) + 1, 1, 1))
+        self.weights[:len(question_ids), :len(OPTION_VALUES)] = weights
+        # Nested lists index several times faster than the array per answer
+        self.weight_rows = self.weights.tolist()
+        
+        # answer_key byte -> option column; anything unrecognised is an unknown letter
+        self.key_options = np.full(256, len(OPTION_VALUES), dtype=np.int64)
+        for value, i in self.option_index.items():
+            self.key_options[ord(value)] = i
+        self.key_options[ord(UNANSWERED_KEY)] = len(OPTION_VALUES) + 1
+
+    @classmethod
+    def default(cls, questions: List[Dict[str, Any]]) -> "QuizScoringEngine":
+        question_ids = [question["id"] for question in questions]
+        weights = np.zeros((len(question_ids), len(OPTION_VALUES), len(ARCHETYPE_KEYS)))
+        for option, archetype in ANSWER_ARCHETYPES.items():
+            weights[:, OPTION_VALUES.index(option), ARCHETYPE_KEYS.index(archetype)] = 1
+        return cls(weights, question_ids)
+
+    @classmethod
+    def from_file(cls, path: str, questions: List[Dict[str, Any]]) -> "QuizScoringEngine":
+        """Load weights from JSON shaped {question_id: {option: {archetype: weight}}};
+        questions and options left out keep the default weights"""
+        engine = cls.default(questions)
+        weights = engine.weights[:len(engine.question_ids), :len(OPTION_VALUES)].copy()
+        with open(path) as f:
+            overrides = json.load(f)
+        for question_id, options in overrides.items():
+            q = engine.question_index[int(question_id)]
+            for option, archetype_weights in options.items():
+                o = engine.option_index[option]
+                weights[q, o] = 0
+                for archetype, weight in archetype_weights.items():
+                    weights[q, o, ARCHETYPE_KEYS.index(archetype)] = weight
+        return cls(weights, engine.question_ids)
+
+    def score(self, answers) -> str:
+        """Archetype for one submission of (question_id, answer) pairs"""
+        unknown_question = len(self.question_ids)
+        unknown_option = len(OPTION_VALUES)
+        rows = [
+            self.weight_rows[self.question_index.get(question_id, unknown_question)][self.option_index.get(answer, unknown_option)]
+            for question_id, answer in answers
+        ]
+        scores = list(map(sum, zip([0.0] * len(ARCHETYPE_KEYS), *rows)))
+        # index() finds the first maximum, so ties follow ARCHETYPE_KEYS order
+        return ARCHETYPE_KEYS[scores.index(max(scores))]
+
+    def answer_key(self, answers: List[Dict[str, Any]]) -> Optional[str]:
+        """Answers as one character per question; None for unknown or repeated questions"""
+        letters = [UNANSWERED_KEY] * len(self.question_ids)
+        for answer in answers:
+            q = self.question_index.get(answer["question_id"])
+            if q is None or letters[q] != UNANSWERED_KEY:
+                return None
+            letters[q] = answer["answer"] if answer["answer"] in self.option_index else UNKNOWN_OPTION_KEY
+        return "".join(letters)
+
+    def score_keys(self, keys: List[str]) -> List[str]:
+        """Archetypes for a batch of answer_keys"""
+        codes = np.frombuffer("".join(keys).encode("ascii"), dtype=np.uint8)
+        options = self.key_options[codes.reshape(len(keys), len(self.question_ids))]
+        scores = np.zeros((len(keys), len(ARCHETYPE_KEYS)))
+        for q in range(len(self.question_ids)):
+            scores += np.take(self.weights[q], options[:, q], axis=0)
+        # argmax returns the first maximum, so ties follow ARCHETYPE_KEYS order
+        return [ARCHETYPE_KEYS[i] for i in scores.argmax(axis=1)]
+
+    def score_results(self, results: List[Dict[str, Any]]) -> List[str]:
+        """Archetypes for stored quiz results, batched by answer_key where it fits"""
+        keyed = [
+            i for i, result in enumerate(results)
+            if len(result.get("answer_key") or "") == len(self.question_ids) and result["answer_key"].isascii()
+        ]
+        archetypes = [None] * len(results)
+        if keyed:
+            for i, archetype in zip(keyed, self.score_keys([results[i]["answer_key"] for i in keyed])):
+                archetypes[i] = archetype
+        for i, result in enumerate(results):
+            if archetypes[i] is None:
+                archetypes[i] = self.score((answer["question_id"], answer["answer"]) for answer in result["answers"])
+        return archetypes
+
+def load_scoring_engine() -> QuizScoringEngine:
+    if QUIZ_WEIGHTS_FILE:
+        return QuizScoringEngine.from_file(QUIZ_WEIGHTS_FILE, QUIZ_QUESTIONS)
+    return QuizScoringEngine.default(QUIZ_QUESTIONS)
+
+quiz_scoring_engine = load_scoring_engine()
+
+def calculate_archetype(answers: List[QuizAnswer]) -> str:
+    """Calculate archetype based on quiz answers"""
+    return quiz_scoring_engine.score((answer.question_id, answer.answer) for answer in answers)
+
+def archetype_result_fields(archetype_key: str) -> Dict[str, Any]:
+    archetype_data = ARCHETYPES[archetype_key]
+    return {
+        "archetype": archetype_key,
+        "archetype_title": archetype_data["title"],
+        "archetype_description": archetype_data["description"],
+        "strengths": archetype_data["strengths"],
+        "areas_to_improve": archetype_data["areas_to_improve"],
+        "recommended_modules": archetype_data["recommended_modules"]
+    }
+
+async def rescore_quiz_results(engine: QuizScoringEngine, batch_size: int = QUIZ_RESCORE_BATCH_SIZE) -> Dict[str, int]:
+    """Re-score every stored quiz result that kept its answers.
+    
+    Documents are streamed from a cursor and scored batch_size at a time, so
+    memory stays bounded however large the collection is. Only results whose
+    archetype changes are written back.
+    """
+    counts = {"scanned": 0, "changed": 0}
+    
+    async def flush(batch: List[Dict[str, Any]]):
+        archetypes = engine.score_results(batch)
+        # updated_at lets /sync hand the new archetype to offline caches
+        now = datetime.now(timezone.utc)
+        updates = [
+            UpdateOne({"_id": doc["_id"]}, {"$set": {**archetype_result_fields(archetype), "updated_at": now}})
+            for doc, archetype in zip(batch, archetypes)
+            if archetype != doc.get("archetype")
+        ]
+        if updates:
+            await db.quiz_results.bulk_write(updates, ordered=False)
+        counts["scanned"] += len(batch)
+        counts["changed"] += len(updates)
+    
+    batch = []
+    cursor = db.quiz_results.find(
+        {"answers": {"$exists": True}},
+        {"answers": 1, "answer_key": 1, "archetype": 1}
+    ).batch_size(batch_size)
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    return counts
+
+def benchmark_quiz_scoring(submissions: int, seed: int = 0) -> Dict[str, float]:
+    """Time score_keys() and score() against the original per-answer loop"""
+    rng = np.random.default_rng(seed)
+    engine = QuizScoringEngine.default(QUIZ_QUESTIONS)
+    letters = np.array(OPTION_VALUES)[rng.integers(0, len(OPTION_VALUES), size=(submissions, len(engine.question_ids)))]
+    keys = ["".join(row) for row in letters]
+    answers = [
+        [{"question_id": question_id, "answer": letter} for question_id, letter in zip(engine.question_ids, key)]
+        for key in keys
+    ]
+    
+    started = time.perf_counter()
+    engine.score_keys(keys)
+    keyed = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for submission in answers:
+        engine.score((answer["question_id"], answer["answer"]) for answer in submission)
+    single = time.perf_counter() - started
+    
+    # The original calculate_archetype loop
+    started = time.perf_counter()
+    for submission in answers:
+        scores = dict.fromkeys(ARCHETYPE_KEYS, 0)
+        for answer in submission:
+            scores[ANSWER_ARCHETYPES.get(answer["answer"], "analytical")] += 1
+        max(scores, key=scores.get)
+    loop = time.perf_counter() - started
+    
+    return {
+        "submissions": submissions,
+        "score_keys_seconds": keyed,
+        "score_seconds": single,
+        "loop_seconds": loop,
+        "score_keys_speedup": loop / keyed if keyed else float("inf"),
+        "score_speedup": loop / single if single else float("inf")
+    }
+
+# ========================
+# FOUNDATION PROMPTS DATA
+# ========================
+
+DAILY_PROMPTS = {
+    "journal": [
+        "What's one situation this week where you felt confident? Describe it.",
+        "Write about a conversation that didn't go well. What would you do differently?",
+        "Describe your ideal confident self. How does he speak, walk, and interact?",
+        "What fear held you back today? How can you face it tomorrow?",
+        "List 3 things you genuinely like about yourself."
+    ],
+    "affirmation": [
+        "I am worthy of love and respect.",
+        "My confidence grows stronger every day.",
+        "I attract positive, healthy relationships.",
+        "I communicate my thoughts clearly and confidently.",
+        "I am comfortable in my own skin."
+    ],
+    "reflection": [
+        "What did you learn about yourself today?",
+        "How did you step out of your comfort zone?",
+        "What interaction made you proud?",
+        "What's one thing you're grateful for?",
+        "What's your intention for tomorrow?"
+    ]
+}
+
+# ========================
+# AI CHAT SCENARIOS
+# ========================
+
+CHAT_SCENARIOS = {
+    "coffee_shop": {
+        "name": "Coffee Shop Approach",
+        "description": "Practice starting conversations with someone at a coffee shop",
+        "system_prompt": """You are playing the role of an attractive, confident woman at a coffee shop for a dating conversation practice app called "Rizz Academy". 
+
+Your character traits:
+- You're friendly but not overly eager
+- You appreciate genuine, confident approaches
+- You respond positively to wit and humor
+- You're slightly guarded at first but warm up to good conversation
+- You have your own opinions and aren't afraid to express them
+
+Guidelines:
+- Stay in character as the woman being approached
+- React naturally to what the user says
+- If they're awkward, be politely distant
+- If they're too pushy, show slight discomfort
+- If they're genuine and interesting, show increasing interest
+- Keep responses concise (1-3 sentences usually)
+- Occasionally ask follow-up questions if engaged
+
+After each response, provide brief coaching feedback in brackets like this:
+[Feedback: Your opening was strong because... / Try to... next time]
+
+Remember: This is practice for real conversations. Help them improve while being realistic."""
+    },
+    "party": {
+        "name": "House Party",
+        "description": "Navigate social dynamics at a party",
+        "system_prompt": """You are playing the role of an attractive woman at a house party for a dating conversation practice app called "Rizz Academy".
+
+Your character traits:
+- You're social and having fun with friends
+- You appreciate someone who can match your energy
+- You're slightly distracted by the party atmosphere
+- You value someone who stands out from typical party approaches
+- You have a good sense of humor
+
+Guidelines:
+- Stay in character as the woman at the party
+- React naturally to the party context
+- Show appreciation for creative openers
+- Be realistic about party dynamics (noise, distractions)
+- Keep responses appropriate for party conversation
+- After each response, provide brief coaching feedback in brackets
+
+[Feedback: Your approach worked because... / Consider trying...]"""
+    },
+    "dating_app": {
+        "name": "Dating App Chat",
+        "description": "Practice messaging matches effectively",
+        "system_prompt": """You are playing the role of a woman who matched on a dating app for a practice app called "Rizz Academy".
+
+Your character traits:
+- You get lots of matches but few good conversations
+- You appreciate originality over generic openers
+- You're quick to unmatch boring conversations
+- You respond well to humor and genuine curiosity
+- You have a busy life and don't text all day
+
+Guidelines:
+- Stay in character as the dating app match
+- React to messages as you would on a real app
+- Show disinterest in generic "hey" type messages
+- Respond positively to creative, engaging messages
+- Keep responses concise like real app conversations
+- After each response, provide brief coaching feedback in brackets
+
+[Feedback: That message stood out because... / Try to...]"""
+    }
+}
+
+# ========================
+# STATIC PAYLOADS
+# ========================
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip, honouring q=0 refusals"""
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+    
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+class StaticPayload:
+    """A JSON payload serialized and gzipped once, served with a strong ETag.
+    
+    The data only changes on deploy, so each request is a header check and
+    a bytes write; clients revalidating with If-None-Match get a 304.
+    """
+
+    def __init__(self, data: Any):
+        self.body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.gzip_body = gzip.compress(self.body, mtime=0)
+        digest = hashlib.sha256(self.body).hexdigest()[:32]
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+
+    def response(self, request: Request) -> Response:
+        use_gzip = accepts_gzip(request.headers.get("accept-encoding", ""))
+        etag = self.gzip_etag if use_gzip else self.etag
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"public, max-age={STATIC_CACHE_MAX_AGE}",
+            "Vary": "Accept-Encoding"
+        }
+        
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            if "*" in tags or etag in tags:
+                return Response(status_code=304, headers=headers)
+        
+        if use_gzip:
+            headers["Content-Encoding"] = "gzip"
+            return Response(content=self.gzip_body, media_type="application/json", headers=headers)
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+QUIZ_QUESTIONS_PAYLOAD = StaticPayload({"questions": QUIZ_QUESTIONS})
+DAILY_PROMPTS_PAYLOAD = StaticPayload(DAILY_PROMPTS)
+SCENARIOS_PAYLOAD = StaticPayload({
+    "scenarios": [
+        {
+            "id": key,
+            "name": data["name"],
+            "description": data["description"]
+        }
+        for key, data in CHAT_SCENARIOS.items()
+    ]
+})
+
+# ========================
+# LLM STREAMING
+# ========================
+
+class StreamingLlmChat:
+    """LlmChat wrapper that streams replies through litellm when LLM_API_BASE is set"""
+
+    def __init__(self, api_key: str, session_id: str, system_message: str, initial_messages: Optional[List[Dict[str, str]]] = None):
+        kwargs = {"initial_messages": initial_messages} if initial_messages else {}
+        self._chat = LlmChat(api_key=api_key, session_id=session_id, system_message=system_message, **kwargs)
+        self._api_key = api_key
+        self._messages = [{"role": "system", "content": system_message}, *(initial_messages or [])]
+        self._model = ""
+
+    def with_model(self, provider: str, model: str):
+        self._chat.with_model(provider, model)
+        self._model = f"{provider}/{model}"
+        return self
+
+    async def send_message(self, user_message: UserMessage) -> str:
+        return await self._chat.send_message(user_message)
+
+    async def stream_message(self, user_message: UserMessage):
+        stream_message = getattr(self._chat, "stream_message", None)
+        if stream_message is not None:
+            async for chunk in stream_message(user_message):
+                yield chunk
+            return
+
+        # Without an explicit endpoint the key only works through LlmChat
+        try:
+            import litellm
+        except ImportError:
+            litellm = None
+        if litellm is None or not LLM_API_BASE:
+            yield await self.send_message(user_message)
+            return
+
+        response = await litellm.acompletion(
+            model=self._model,
+            messages=self._messages + [{"role": "user", "content": user_message.text}],
+            api_key=self._api_key,
+            api_base=LLM_API_BASE,
+            stream=True
+        )
+        async for chunk in response:
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                yield text
+
+# ========================
+# LLM RECORD / REPLAY
+# ========================
+
+def llm_exchange_key(model: str, system_message: str, initial_messages: List[Dict[str, str]], text: str) -> str:
+    raw = json.dumps([model, system_message, initial_messages, text], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def llm_system_hash(system_message: str) -> str:
+    return hashlib.sha256(system_message.encode()).hexdigest()[:16]
+
+class LlmRecordings:
+    """Recorded LLM exchanges (JSON lines) and the replay lookup over them"""
+
+    def __init__(self):
+        self._by_key: Dict[str, Dict[str, Any]] = {}
+        self._by_system: Dict[str, List[Dict[str, Any]]] = {}
+        self._all: List[Dict[str, Any]] = []
+        self.recorded = 0
+        self.exact_hits = 0
+        self.fallback_hits = 0
+        self.injected_errors = 0
+        self.injected_timeouts = 0
+
+    def load(self, path: str):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    self._add(json.loads(line))
+        if not self._all:
+            raise RuntimeError(f"No recorded LLM exchanges in {path}")
+        logger.info(f"Loaded {len(self._all)} recorded LLM exchanges from {path}")
+
+    def _add(self, record: Dict[str, Any]):
+        self._by_key.setdefault(record["key"], record)
+        self._by_system.setdefault(record["system_hash"], []).append(record)
+        self._all.append(record)
+
+    def append(self, record: Dict[str, Any]):
+        with open(LLM_RECORDING_FILE, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.recorded += 1
+
+    def find(self, key: str, system_hash: str) -> Dict[str, Any]:
+        record = self._by_key.get(key)
+        if record is not None:
+            self.exact_hits += 1
+            return record
+        
+        self.fallback_hits += 1
+        candidates = self._by_system.get(system_hash) or self._all
+        return candidates[int(key[:8], 16) % len(candidates)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": LLM_MODE,
+            "recordings": len(self._all),
+            "recorded": self.recorded,
+            "exact_hits": self.exact_hits,
+            "fallback_hits": self.fallback_hits,
+            "injected_errors": self.injected_errors,
+            "injected_timeouts": self.injected_timeouts
+        }
+
+llm_recordings = LlmRecordings()
+
+class RecordingLlmChat:
+    """LlmChat wrapper that records every exchange with its timings"""
+
+    def __init__(self, api_key: str, session_id: str, system_message: str, initial_messages: Optional[List[Dict[str, str]]] = None):
+        self._chat = StreamingLlmChat(api_key, session_id, system_message, initial_messages)
+        self._session_id = session_id
+        self._system_message = system_message
+        self._initial_messages = initial_messages or []
+        self._model = ""
+
+    def with_model(self, provider: str, model: str):
+        self._chat.with_model(provider, model)
+        self._model = f"{provider}/{model}"
+        return self
+
+    def _record(self, text: str, reply: str, latency_ms: float, chunks: List[List[Any]]):
+        llm_recordings.append({
+            "key": llm_exchange_key(self._model, self._system_message, self._initial_messages, text),
+            "system_hash": llm_system_hash(self._system_message),
+            "model": self._model,
+            "session_id": self._session_id,
+            "text": text,
+            "reply": reply,
+            "latency_ms": latency_ms,
+            "chunks": chunks,
+            "recorded_at": datetime.now(timezone.utc).isoformat()
+        })
+
+    async def send_message(self, user_message: UserMessage) -> str:
+        started = time.perf_counter()
+        reply = await self._chat.send_message(user_message)
+        self._record(user_message.text, reply, (time.perf_counter() - started) * 1000, [])
+        return reply
+
+    async def stream_message(self, user_message: UserMessage):
+        started = time.perf_counter()
+        chunks = []
+        async for chunk in self._chat.stream_message(user_message):
+            chunks.append([(time.perf_counter() - started) * 1000, chunk])
+            yield chunk
+        self._record(user_message.text, "".join(chunk for _, chunk in chunks), (time.perf_counter() - started) * 1000, chunks)
+
+class ReplayLlmChat:
+    """Drop-in LlmChat that serves recorded exchanges with their timing.
+    
+    Replies wait the recorded latency (scaled by LLM_REPLAY_TIME_SCALE) and
+    streams reproduce the recorded chunk offsets; exchanges recorded without
+    streaming are streamed word by word over their latency. A seeded RNG
+    injects errors and timeouts at the configured rates.
+    """
+
+    _rng = random.Random(LLM_REPLAY_SEED)
+
+    def __init__(self, api_key: str, session_id: str, system_message: str, initial_messages: Optional[List[Dict[str, str]]] = None):
+        self._system_message = system_message
+        self._initial_messages = initial_messages or []
+        self._model = ""
+
+    def with_model(self, provider: str, model: str):
+        self._model = f"{provider}/{model}"
+        return self
+
+    async def _replay(self, user_message: UserMessage) -> Dict[str, Any]:
+        key = llm_exchange_key(self._model, self._system_message, self._initial_messages, user_message.text)
+        record = llm_recordings.find(key, llm_system_hash(self._system_message))
+        
+        roll = self._rng.random()
+        if roll < LLM_REPLAY_TIMEOUT_RATE:
+            llm_recordings.injected_timeouts += 1
+            await asyncio.sleep(LLM_REPLAY_TIMEOUT_SECONDS * LLM_REPLAY_TIME_SCALE)
+            raise asyncio.TimeoutError("Injected LLM timeout")
+        if roll < LLM_REPLAY_TIMEOUT_RATE + LLM_REPLAY_ERROR_RATE:
+            llm_recordings.injected_errors += 1
+            raise RuntimeError("Injected LLM error")
+        return record
+
+    async def send_message(self, user_message: UserMessage) -> str:
+        record = await self._replay(user_message)
+        await asyncio.sleep(record["latency_ms"] / 1000 * LLM_REPLAY_TIME_SCALE)
+        return record["reply"]
+
+    async def stream_message(self, user_message: UserMessage):
+        record = await self._replay(user_message)
+        chunks = record["chunks"]
+        if not chunks:
+            words = record["reply"].split(" ")
+            step = record["latency_ms"] / len(words)
+            chunks = [[step * (i + 1), word if i == 0 else " " + word] for i, word in enumerate(words)]
+        
+        elapsed_ms = 0.0
+        for offset_ms, chunk in chunks:
+            await asyncio.sleep(max(0.0, offset_ms - elapsed_ms) / 1000 * LLM_REPLAY_TIME_SCALE)
+            elapsed_ms = offset_ms
+            yield chunk
+
+def new_llm_chat(session_id: str, system_message: str, initial_messages: Optional[List[Dict[str, str]]] = None):
+    """Create the chat client for LLM_MODE, metered when metrics are enabled"""
+    if LLM_MODE == "replay":
+        chat = ReplayLlmChat(EMERGENT_LLM_KEY, session_id, system_message, initial_messages)
+    elif LLM_MODE == "record":
+        chat = RecordingLlmChat(EMERGENT_LLM_KEY, session_id, system_message, initial_messages)
+    else:
+        chat = StreamingLlmChat(EMERGENT_LLM_KEY, session_id, system_message, initial_messages)
+    
+    if METRICS_ENABLED:
+        return MeteredLlmChat(chat, SCENARIO_BY_SYSTEM_PROMPT.get(system_message, "other"))
+    return chat
+
+# ========================
+# AI CHAT HELPERS
+# ========================
+
+LLM_FALLBACK_RESPONSE = "Sorry, I'm a bit distracted right now. Can you say that again? [Feedback: Keep practicing! The AI service had a temporary issue.]"
+
+FEEDBACK_MARKER = "[Feedback:"
+
+DUPLICATE_KEY_ERROR = 11000
+
+class ChatWriteQueue:
+    """Bounded queue that persists chat turns after the reply has been sent.
+    
+    A single worker drains whatever is queued into one insert_many for
+    chat_messages, retrying transient errors. Messages stay visible through pending_messages()
+    until they are written, so reads on this worker see their own writes.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._pending: Dict[tuple, Dict[str, Dict[str, Any]]] = {}
+        self.flushed_batches = 0
+        self.written_messages = 0
+        self.retries = 0
+        self.failed_batches = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=WRITE_QUEUE_MAX_SIZE)
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop accepting writes and drain everything already queued"""
+        if self._worker is None:
+            return
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+
+    async def submit(self, user_id: str, session_id: str, messages: List[Dict[str, Any]]):
+        pending = self._pending.setdefault((user_id, session_id), {})
+        for message in messages:
+            pending[message["message_id"]] = message
+        # Waits when the queue is full, pushing back on the request handlers
+        await self._queue.put({
+            "user_id": user_id,
+            "session_id": session_id,
+            "messages": messages
+        })
+
+    def pending_messages(self, user_id: str, session_id: str) -> List[Dict[str, Any]]:
+        return list(self._pending.get((user_id, session_id), {}).values())
+
+    async def _run(self):
+        closing = False
+        while not closing:
+            batch = [await self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            if None in batch:
+                closing = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        # Copies, because insert_many adds an ObjectId _id to the documents
+        messages = [dict(message) for item in batch for message in item["messages"]]
+        
+        try:
+            await self._with_retries(self._insert_messages, messages)
+            self.flushed_batches += 1
+            self.written_messages += len(messages)
+        except Exception as e:
+            self.failed_batches += 1
+            logger.error(f"Chat write batch of {len(batch)} turns failed: {e}")
+        finally:
+            for item in batch:
+                pending = self._pending.get((item["user_id"], item["session_id"]), {})
+                for message in item["messages"]:
+                    pending.pop(message["message_id"], None)
+                if not pending:
+                    self._pending.pop((item["user_id"], item["session_id"]), None)
+
+    async def _insert_messages(self, messages: List[Dict[str, Any]]):
+        try:
+            await db.chat_messages.insert_many(messages, ordered=False)
+        except BulkWriteError as e:
+            # Documents written by an earlier attempt come back as duplicates
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+
+    async def _with_retries(self, operation, *args, **kwargs):
+        for attempt in range(WRITE_MAX_RETRIES + 1):
+            try:
+                return await operation(*args, **kwargs)
+            except ConnectionFailure:
+                if attempt == WRITE_MAX_RETRIES:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(WRITE_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": WRITE_QUEUE_ENABLED,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "pending_sessions": len(self._pending),
+            "flushed_batches": self.flushed_batches,
+            "written_messages": self.written_messages,
+            "retries": self.retries,
+            "failed_batches": self.failed_batches
+        }
+
+chat_write_queue = ChatWriteQueue()
+
+def merge_pending_messages(
+    messages: List[Dict[str, Any]],
+    user_id: str,
+    session_id: str,
+    limit: int
+) -> List[Dict[str, Any]]:
+    """Add this worker's not-yet-written messages to stored session messages"""
+    pending = chat_write_queue.pending_messages(user_id, session_id)
+    if not pending:
+        return messages
+    
+    stored_ids = {message["message_id"] for message in messages}
+    messages = messages + [message for message in pending if message["message_id"] not in stored_ids]
+    messages.sort(key=lambda message: keyset_key(message, "message_id"))
+    return messages[-limit:]
+
+class SessionHistoryCache:
+    """Write-through ring buffer of recent messages per (user_id, session_id).
+    
+    Sessions are evicted least recently used first once the estimated size
+    of all buffers passes max_bytes, and dropped after idle_seconds without
+    access. An entry is "complete" while it still holds every message of the
+    session, which is when it can serve /combat/history on its own.
+    """
+
+    MESSAGE_OVERHEAD_BYTES = 256
+
+    def __init__(self, max_messages: int, max_bytes: int, idle_seconds: float):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
-def calculate_archetype(answers: List[QuizAnswer]) -> str:
-    """Calculate archetype based on quiz answers"""
-    scores = {"analytical": 0, "adventurer": 0, "alpha": 0, "empath": 0}
+    def get_state(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get((user_id, session_id))
+        return entry.get("state") if entry else None
+
+    def set_state(self, user_id: str, session_id: str, state: Dict[str, Any]):
+        entry = self._entries.get((user_id, session_id))
+        if entry is not None:
+            entry["state"] = state
+
+    def _message_bytes(self, message: Dict[str, Any]) -> int:
+        return len(message.get("content", "")) + self.MESSAGE_OVERHEAD_BYTES
+
+    def get(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        key = (user_id, session_id)
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry["last_access"] > self.idle_seconds:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        
+        entry["last_access"] = time.monotonic()
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def load(self, user_id: str, session_id: str, messages: List[Dict[str, Any]], complete: bool):
+        key = (user_id, session_id)
+        if key in self._entries:
+            self._remove(key)
+        
+        entry = {
+            "messages": deque(maxlen=self.max_messages),
+            "complete": complete,
+            "bytes": 0,
+            "last_access": time.monotonic()
+        }
+        self._entries[key] = entry
+        self._extend(entry, messages)
+        self._evict()
+
+    def append(self, user_id: str, session_id: str, messages: List[Dict[str, Any]]):
+        """Write through new messages if the session is cached"""
+        key = (user_id, session_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry["last_access"] = time.monotonic()
+        self._entries.move_to_end(key)
+        self._extend(entry, messages)
+        self._evict()
+
+    def _extend(self, entry: Dict[str, Any], messages: List[Dict[str, Any]]):
+        for message in messages:
+            if len(entry["messages"]) == self.max_messages:
+                dropped = self._message_bytes(entry["messages"][0])
+                entry["bytes"] -= dropped
+                self.total_bytes -= dropped
+                entry["complete"] = False
+            entry["messages"].append(message)
+            added = self._message_bytes(message)
+            entry["bytes"] += added
+            self.total_bytes += added
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry["bytes"]
+
+    def _expire(self):
+        # Entries are kept in access order, so the idle ones are at the front
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry["last_access"] <= self.idle_seconds:
+                break
+            self._remove(key)
+            self.expirations += 1
+
+    def _evict(self):
+        self._expire()
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        self._expire()
+        lookups = self.hits + self.misses
+        return {
+            "enabled": HISTORY_CACHE_ENABLED,
+            "sessions": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+session_history_cache = SessionHistoryCache(
+    HISTORY_CACHE_MESSAGES_PER_SESSION,
+    HISTORY_CACHE_MAX_BYTES,
+    HISTORY_CACHE_IDLE_SECONDS
+)
+
+async def get_session_history(user_id: str, session_id: str) -> List[Dict[str, Any]]:
+    """Get the most recent messages of a chat session, oldest first"""
+    if HISTORY_CACHE_ENABLED:
+        entry = session_history_cache.get(user_id, session_id)
+        if entry:
+            return list(entry["messages"])[-50:]
+    
+    limit = HISTORY_CACHE_MESSAGES_PER_SESSION if HISTORY_CACHE_ENABLED else 50
+    history = await db.chat_messages.find(
+        {
+            "user_id": user_id,
+            "session_id": session_id
+        },
+        {"_id": 0}
+    ).sort([("timestamp", DESCENDING), ("message_id", DESCENDING)]).to_list(limit)
+    history.reverse()
+    history = merge_pending_messages(history, user_id, session_id, limit)
+    
+    if HISTORY_CACHE_ENABLED:
+        session_history_cache.load(user_id, session_id, history, complete=len(history) < limit)
+    return history[-50:]
+
+def create_scenario_chat(
+    session_id: str,
+    scenario: Dict[str, Any],
+    initial_messages: Optional[List[Dict[str, str]]] = None
+) -> LlmChat:
+    """Create an LLM chat primed with the scenario's system prompt"""
+    chat = new_llm_chat(session_id, scenario["system_prompt"], initial_messages)
+    chat.with_model("openai", "gpt-4.1")
+    return chat
+
+def prepare_chat(
+    session_id: str,
+    scenario: Dict[str, Any],
+    history: List[Dict[str, Any]],
+    message: str,
+    state: Optional[Dict[str, Any]]
+):
+    """Create the LLM chat and user message for a turn in PROMPT_LAYOUT"""
+    if PROMPT_LAYOUT == "messages":
+        chat = create_scenario_chat(session_id, scenario, build_chat_messages(history, state))
+        return chat, UserMessage(text=message)
+    
+    chat = create_scenario_chat(session_id, scenario)
+    return chat, build_user_message(history, message, state)
+
+# Set by the startup hook; None until then or when the tokenizer is unavailable
+token_encoding = None
+
+def tokenizer_cache_dir() -> Optional[str]:
+    if TOKENIZER_CACHE_DIR:
+        return TOKENIZER_CACHE_DIR
+    try:
+        from importlib import resources
+        import litellm
+    except ImportError:
+        return None
+    return str(resources.files(litellm).joinpath("litellm_core_utils/tokenizers"))
+
+def load_token_encoding():
+    """Load the gpt-4.1 tokenizer from the local BPE file (blocking)"""
+    import tiktoken
+    cache_dir = tokenizer_cache_dir()
+    if cache_dir:
+        # tiktoken only downloads the BPE file when it is missing here
+        os.environ["TIKTOKEN_CACHE_DIR"] = cache_dir
+    return tiktoken.get_encoding("o200k_base")
+
+async def startup_token_encoding():
+    global token_encoding
+    try:
+        token_encoding = await asyncio.wait_for(asyncio.to_thread(load_token_encoding), TOKENIZER_LOAD_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"Tokenizer did not load within {TOKENIZER_LOAD_TIMEOUT_SECONDS}s, estimating token counts")
+    except Exception as e:
+        logger.warning(f"Tokenizer unavailable, estimating token counts: {e}")
+
+def count_tokens(text: str) -> int:
+    """Count tokens with the gpt-4.1 tokenizer, or estimate ~4 chars per token"""
+    if token_encoding is None:
+        return len(text) // 4 + 1
+    return len(token_encoding.encode(text))
+
+def utc_naive(value: datetime) -> datetime:
+    """Normalize a UTC datetime for comparison with naive values from Mongo"""
+    return value.replace(tzinfo=None)
+
+def unsummarized_messages(history: List[Dict[str, Any]], state: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop the messages already covered by the session's rolling summary"""
+    if not state or not state.get("summarized_until"):
+        return history
+    if "summarized_until_id" not in state:
+        summarized_until = utc_naive(state["summarized_until"])
+        return [msg for msg in history if utc_naive(msg["timestamp"]) > summarized_until]
+    boundary = keyset_key({"timestamp": state["summarized_until"], "message_id": state["summarized_until_id"]}, "message_id")
+    return [msg for msg in history if keyset_key(msg, "message_id") > boundary]
+
+def format_history_line(msg: Dict[str, Any]) -> str:
+    role = "User" if msg["role"] == "user" else "Her"
+    return f"{role}: {msg['content']}\n"
+
+def build_user_message(
+    history: List[Dict[str, Any]],
+    message: str,
+    state: Optional[Dict[str, Any]] = None
+) -> UserMessage:
+    """Build the LLM user message, prefixed with as much recent history as
+    fits in CONTEXT_TOKEN_BUDGET and the rolling summary of older turns"""
+    summary = state.get("summary") if state else None
+    history = unsummarized_messages(history, state)
+    if not history and not summary:
+        return UserMessage(text=message)
+    
+    budget = CONTEXT_TOKEN_BUDGET - count_tokens(message)
+    context = ""
+    if summary:
+        context = f"Summary of earlier conversation:\n{summary}\n\n"
+        budget -= count_tokens(context)
+    
+    lines = []
+    for msg in reversed(history):
+        line = format_history_line(msg)
+        budget -= count_tokens(line)
+        if budget < 0:
+            break
+        lines.append(line)
+    
+    if lines:
+        context += "Previous conversation:\n" + "".join(reversed(lines))
+    context += "\nContinue the conversation:\n"
+    return UserMessage(text=context + message)
+
+def build_chat_messages(
+    history: List[Dict[str, Any]],
+    state: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, str]]:
+    """Build prior turns as structured messages for the "messages" layout"""
+    messages = []
+    if state and state.get("summary"):
+        messages.append({"role": "system", "content": f"Summary of earlier conversation:\n{state['summary']}"})
+    for msg in unsummarized_messages(history, state):
+        messages.append({"role": "user" if msg["role"] == "user" else "assistant", "content": msg["content"]})
+    return messages
+
+class ResponseCache:
+    """TTL/LRU cache of LLM replies to near-identical early-session messages.
+    
+    A reply may be reused only when the session has no summary, at most
+    RESPONSE_CACHE_MAX_HISTORY prior messages and the message is at most
+    RESPONSE_CACHE_MAX_MESSAGE_CHARS long. The key covers the scenario, the
+    normalized message and a hash of that short history. Memory is checked
+    first; the optional Mongo tier lets workers share hits.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.scenarios: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", "", text.lower()).split())
+
+    def key_for(
+        self,
+        scenario: str,
+        message: str,
+        history: List[Dict[str, Any]],
+        state: Optional[Dict[str, Any]]
+    ) -> Optional[str]:
+        """Cache key for a turn, or None when the policy forbids reuse"""
+        if not RESPONSE_CACHE_ENABLED or (state and state.get("summary")):
+            return None
+        if len(history) > RESPONSE_CACHE_MAX_HISTORY or len(message) > RESPONSE_CACHE_MAX_MESSAGE_CHARS:
+            return None
+        
+        parts = [scenario] + [f"{msg['role']}:{self.normalize(msg['content'])}" for msg in history]
+        parts.append(f"user:{self.normalize(message)}")
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def _count(self, scenario: str, outcome: str):
+        stats = self.scenarios.setdefault(scenario, {"hits": 0, "mongo_hits": 0, "misses": 0})
+        stats[outcome] += 1
+
+    async def get(self, key: str, scenario: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            response_text, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self._count(scenario, "hits")
+                return response_text
+            del self._entries[key]
+        
+        if RESPONSE_CACHE_MONGO_ENABLED:
+            doc = await db.llm_response_cache.find_one(
+                {"key": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+                {"_id": 0, "response": 1, "expires_at": 1}
+            )
+            if doc:
+                expires_at = doc["expires_at"].replace(tzinfo=timezone.utc)
+                remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+                self._store(key, doc["response"], remaining)
+                self._count(scenario, "mongo_hits")
+                return doc["response"]
+        
+        self._count(scenario, "misses")
+        return None
+
+    async def set(self, key: str, scenario: str, response_text: str):
+        self._store(key, response_text, self.ttl_seconds)
+        if RESPONSE_CACHE_MONGO_ENABLED:
+            await db.llm_response_cache.update_one(
+                {"key": key},
+                {"$set": {
+                    "key": key,
+                    "scenario": scenario,
+                    "response": response_text,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+                }},
+                upsert=True
+            )
+
+    def _store(self, key: str, response_text: str, ttl_seconds: float):
+        self._entries[key] = (response_text, time.monotonic() + ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        scenarios = {}
+        for scenario, stats in self.scenarios.items():
+            lookups = stats["hits"] + stats["mongo_hits"] + stats["misses"]
+            scenarios[scenario] = {
+                **stats,
+                "hit_rate": (stats["hits"] + stats["mongo_hits"]) / lookups if lookups else 0.0
+            }
+        return {"enabled": RESPONSE_CACHE_ENABLED, "size": len(self._entries), "scenarios": scenarios}
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL_SECONDS)
+
+async def get_session_state(user_id: str, session_id: str) -> Dict[str, Any]:
+    """Get the per-session state document holding the rolling summary"""
+    state = session_history_cache.get_state(user_id, session_id) if HISTORY_CACHE_ENABLED else None
+    if state is not None:
+        return state
+    
+    state = await db.chat_sessions.find_one(
+        {"user_id": user_id, "session_id": session_id},
+        {"_id": 0}
+    ) or {}
+    if HISTORY_CACHE_ENABLED:
+        session_history_cache.set_state(user_id, session_id, state)
+    return state
+
+SUMMARY_SYSTEM_PROMPT = """You summarize dating conversation practice sessions from the app "Rizz Academy".
+Write a compact summary (at most 5 sentences) of the conversation so far: the setting, what the user said,
+how she reacted and any facts, names or plans mentioned. Merge the previous summary with the new messages.
+Reply with the summary only."""
+
+summarizing_sessions = set()
+summary_tasks = set()
+
+def maybe_summarize_session(
+    user_id: str,
+    session_id: str,
+    history: List[Dict[str, Any]],
+    state: Dict[str, Any]
+):
+    """Fold older turns into the rolling summary in the background once the
+    unsummarized part of the session passes CONTEXT_SUMMARY_TRIGGER_MESSAGES"""
+    if not CONTEXT_SUMMARY_ENABLED:
+        return
+    
+    pending = unsummarized_messages(history, state)
+    key = (user_id, session_id)
+    if len(pending) <= CONTEXT_SUMMARY_TRIGGER_MESSAGES or key in summarizing_sessions:
+        return
+    
+    summarizing_sessions.add(key)
+    task = asyncio.create_task(
+        summarize_session(user_id, session_id, pending[:-CONTEXT_SUMMARY_KEEP_MESSAGES], state)
+    )
+    summary_tasks.add(task)
+    task.add_done_callback(summary_tasks.discard)
+
+async def summarize_session(
+    user_id: str,
+    session_id: str,
+    messages: List[Dict[str, Any]],
+    state: Dict[str, Any]
+):
+    try:
+        chat = new_llm_chat(f"{session_id}-summary", SUMMARY_SYSTEM_PROMPT)
+        chat.with_model("openai", CONTEXT_SUMMARY_MODEL)
+        
+        text = ""
+        if state.get("summary"):
+            text = f"Previous summary:\n{state['summary']}\n\n"
+        text += "New messages:\n" + "".join(format_history_line(msg) for msg in messages)
+        summary = (await chat.send_message(UserMessage(text=text))).strip()
+        
+        new_state = {
+            "user_id": user_id,
+            "session_id": session_id,
+            "summary": summary,
+            "summarized_until": messages[-1]["timestamp"],
+            "summarized_until_id": messages[-1]["message_id"],
+            "summary_tokens": count_tokens(summary),
+            "updated_at": datetime.now(timezone.utc)
+        }
+        await db.chat_sessions.update_one(
+            {"user_id": user_id, "session_id": session_id},
+            {"$set": new_state},
+            upsert=True
+        )
+        if HISTORY_CACHE_ENABLED:
+            session_history_cache.set_state(user_id, session_id, new_state)
+    except Exception as e:
+        logger.error(f"Session summary error: {e}")
+    finally:
+        summarizing_sessions.discard((user_id, session_id))
+
+def split_feedback(response_text: str):
+    """Split an LLM reply into the in-character response and coaching feedback"""
+    if FEEDBACK_MARKER not in response_text:
+        return response_text, None
+    
+    parts = response_text.split(FEEDBACK_MARKER)
+    main_response = parts[0].strip()
+    feedback = parts[1].replace("]", "").strip() if len(parts) > 1 else None
+    return main_response, feedback
+
+class FeedbackStreamSplitter:
+    """Incrementally split streamed LLM text at the [Feedback: ...] marker.
+
+    feed() returns the response text that is safe to forward; a tail that
+    could be the start of the marker is held back until the next chunk.
+    """
+
+    def __init__(self):
+        self.response = ""
+        self._pending = ""
+        self._feedback_parts: Optional[List[str]] = None
+
+    def feed(self, chunk: str) -> str:
+        if self._feedback_parts is not None:
+            self._feedback_parts.append(chunk)
+            return ""
+        
+        self._pending += chunk
+        marker_at = self._pending.find(FEEDBACK_MARKER)
+        if marker_at != -1:
+            text = self._pending[:marker_at]
+            self._feedback_parts = [self._pending[marker_at + len(FEEDBACK_MARKER):]]
+            self._pending = ""
+        else:
+            held = 0
+            for size in range(min(len(FEEDBACK_MARKER) - 1, len(self._pending)), 0, -1):
+                if FEEDBACK_MARKER.startswith(self._pending[-size:]):
+                    held = size
+                    break
+            text = self._pending[:len(self._pending) - held]
+            self._pending = self._pending[len(self._pending) - held:]
+        
+        self.response += text
+        return text
+
+    def finish(self) -> str:
+        text, self._pending = self._pending, ""
+        self.response += text
+        return text
+
+    @property
+    def feedback(self) -> Optional[str]:
+        if self._feedback_parts is None:
+            return None
+        return "".join(self._feedback_parts).replace("]", "").strip()
+
+async def stream_llm_reply(chat: LlmChat, user_message: UserMessage):
+    """Yield the LLM reply as text chunks.
+    
+    Chats from new_llm_chat() always stream; anything without
+    stream_message() yields the full completion as a single chunk.
+    """
+    stream_message = getattr(chat, "stream_message", None)
+    if stream_message is None:
+        yield await chat.send_message(user_message)
+        return
+    
+    async for chunk in stream_message(user_message):
+        yield chunk
+
+async def stream_chat_turn(
+    user: User,
+    session_id: str,
+    chat_request: ChatRequest,
+    scenario: Dict[str, Any],
+    history: List[Dict[str, Any]]
+):
+    """Run one chat turn, yielding (event, data) pairs as the reply streams.
+    
+    Yields "token" events as text arrives, a "feedback" event once the
+    coaching section is complete and a final "done" event. The turn is
+    saved only after the LLM stream finishes, and the saved messages are
+    appended to history.
+    """
+    started = time.perf_counter()
+    ttft_ms = None
+    splitter = FeedbackStreamSplitter()
+    state = await get_session_state(user.user_id, session_id)
+    
+    cache_key = response_cache.key_for(chat_request.scenario, chat_request.message, history, state)
+    cached_text = await response_cache.get(cache_key, chat_request.scenario) if cache_key else None
+    
+    try:
+        if cached_text is not None:
+            chunks = [cached_text]
+        else:
+            chat, user_message = prepare_chat(session_id, scenario, history, chat_request.message, state)
+            chunks = stream_llm_reply(chat, user_message)
+        
+        response_parts = []
+        async for chunk in iterate_chunks(chunks):
+            response_parts.append(chunk)
+            text = splitter.feed(chunk)
+            if text:
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - started) * 1000
+                yield "token", {"text": text}
+        
+        if cache_key and cached_text is None:
+            await response_cache.set(cache_key, chat_request.scenario, "".join(response_parts))
+    except Exception as e:
+        logger.error(f"LLM stream error: {e}")
+        if not splitter.response:
+            splitter = FeedbackStreamSplitter()
+            text = splitter.feed(LLM_FALLBACK_RESPONSE)
+            yield "token", {"text": text}
+    
+    text = splitter.finish()
+    if text:
+        yield "token", {"text": text}
     
-    answer_map = {
-        "A": "analytical",
-        "B": "adventurer", 
-        "C": "alpha",
-        "D": "empath"
+    main_response, feedback = splitter.response.strip(), splitter.feedback
+    if feedback is not None:
+        yield "feedback", {"feedback": feedback}
+    
+    history.extend(await save_chat_turn(user, session_id, chat_request, main_response))
+    maybe_summarize_session(user.user_id, session_id, history, state)
+    
+    logger.info(f"Chat stream ttft_ms={ttft_ms} total_ms={(time.perf_counter() - started) * 1000:.1f}")
+    yield "done", {
+        "response": main_response,
+        "session_id": session_id,
+        "feedback": feedback,
+        "ttft_ms": ttft_ms
     }
+
+async def iterate_chunks(chunks):
+    """Iterate a plain list or an async generator of text chunks"""
+    if isinstance(chunks, list):
+        for chunk in chunks:
+            yield chunk
+        return
+    async for chunk in chunks:
+        yield chunk
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def save_chat_turn(
+    user: User,
+    session_id: str,
+    chat_request: ChatRequest,
+    main_response: str
+) -> List[Dict[str, Any]]:
+    """Save the user and assistant messages of a turn and award practice XP"""
+    user_msg = ChatMessage(
+        user_id=user.user_id,
+        session_id=session_id,
+        role="user",
+        content=chat_request.message,
+        scenario=chat_request.scenario
+    )
+    # Both messages share a timestamp; the reply's later message_id keeps
+    # the turn together and in order
+    assistant_msg = ChatMessage(
+        user_id=user.user_id,
+        session_id=session_id,
+        role="assistant",
+        content=main_response,
+        scenario=chat_request.scenario,
+        timestamp=user_msg.timestamp
+    )
     
-    for answer in answers:
-        archetype = answer_map.get(answer.answer, "analytical")
-        scores[archetype] += 1
+    messages = [user_msg.dict(), assistant_msg.dict()]
     
-    return max(scores, key=scores.get)
+    if HISTORY_CACHE_ENABLED:
+        session_history_cache.append(user.user_id, session_id, messages)
+    
+    if WRITE_QUEUE_ENABLED:
+        await chat_write_queue.submit(user.user_id, session_id, messages)
+    else:
+        # Copies, because insert_one adds an ObjectId _id to the document
+        await db.chat_messages.insert_one(dict(messages[0]))
+        await db.chat_messages.insert_one(dict(messages[1]))
+    
+    # Add XP for practicing
+    await award_xp(user.user_id, 10)
+    return messages
 
 # ========================
-# AI CHAT SCENARIOS
+# LLM USAGE INSTRUMENTATION
 # ========================
 
-CHAT_SCENARIOS = {
-    "coffee_shop": {
-        "name": "Coffee Shop Approach",
-        "description": "Practice starting conversations with someone at a coffee shop",
-        "system_prompt": """You are playing the role of an attractive, confident woman at a coffee shop for a dating conversation practice app called "Rizz Academy". 
+SCENARIO_BY_SYSTEM_PROMPT = {data["system_prompt"]: key for key, data in CHAT_SCENARIOS.items()}
+SCENARIO_BY_SYSTEM_PROMPT[SUMMARY_SYSTEM_PROMPT] = "summary"
 
-Your character traits:
-- You're friendly but not overly eager
-- You appreciate genuine, confident approaches
-- You respond positively to wit and humor
-- You're slightly guarded at first but warm up to good conversation
-- You have your own opinions and aren't afraid to express them
+class PromptCacheStats:
+    """Cached vs uncached prompt tokens per scenario, from LLM usage reports"""
 
-Guidelines:
-- Stay in character as the woman being approached
-- React naturally to what the user says
-- If they're awkward, be politely distant
-- If they're too pushy, show slight discomfort
-- If they're genuine and interesting, show increasing interest
-- Keep responses concise (1-3 sentences usually)
-- Occasionally ask follow-up questions if engaged
+    def __init__(self):
+        self.scenarios: Dict[str, Dict[str, int]] = {}
 
-After each response, provide brief coaching feedback in brackets like this:
-[Feedback: Your opening was strong because... / Try to... next time]
+    def record(self, scenario: str, prompt_tokens: int, cached_tokens: int):
+        stats = self.scenarios.setdefault(scenario, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens
 
-Remember: This is practice for real conversations. Help them improve while being realistic."""
-    },
-    "party": {
-        "name": "House Party",
-        "description": "Navigate social dynamics at a party",
-        "system_prompt": """You are playing the role of an attractive woman at a house party for a dating conversation practice app called "Rizz Academy".
+    def stats(self) -> Dict[str, Any]:
+        return {
+            scenario: {
+                **stats,
+                "uncached_tokens": stats["prompt_tokens"] - stats["cached_tokens"],
+                "cache_hit_rate": stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+            }
+            for scenario, stats in self.scenarios.items()
+        }
 
-Your character traits:
-- You're social and having fun with friends
-- You appreciate someone who can match your energy
-- You're slightly distracted by the party atmosphere
-- You value someone who stands out from typical party approaches
-- You have a good sense of humor
+prompt_cache_stats = PromptCacheStats()
 
-Guidelines:
-- Stay in character as the woman at the party
-- React naturally to the party context
-- Show appreciation for creative openers
-- Be realistic about party dynamics (noise, distractions)
-- Keep responses appropriate for party conversation
-- After each response, provide brief coaching feedback in brackets
+class MeteredLlmChat:
+    """Chat wrapper recording call duration, time to first token and errors by scenario"""
 
-[Feedback: Your approach worked because... / Consider trying...]"""
-    },
-    "dating_app": {
-        "name": "Dating App Chat",
-        "description": "Practice messaging matches effectively",
-        "system_prompt": """You are playing the role of a woman who matched on a dating app for a practice app called "Rizz Academy".
+    def __init__(self, chat, scenario: str):
+        self._chat = chat
+        self._labels = (scenario,)
 
-Your character traits:
-- You get lots of matches but few good conversations
-- You appreciate originality over generic openers
-- You're quick to unmatch boring conversations
-- You respond well to humor and genuine curiosity
-- You have a busy life and don't text all day
+    def with_model(self, provider: str, model: str):
+        self._chat.with_model(provider, model)
+        return self
 
-Guidelines:
-- Stay in character as the dating app match
-- React to messages as you would on a real app
-- Show disinterest in generic "hey" type messages
-- Respond positively to creative, engaging messages
-- Keep responses concise like real app conversations
-- After each response, provide brief coaching feedback in brackets
+    async def send_message(self, user_message: UserMessage) -> str:
+        started = time.perf_counter()
+        try:
+            return await self._chat.send_message(user_message)
+        except Exception:
+            llm_errors_total.inc(self._labels)
+            raise
+        finally:
+            llm_request_duration.observe(self._labels, time.perf_counter() - started)
 
-[Feedback: That message stood out because... / Try to...]"""
-    }
-}
+    async def stream_message(self, user_message: UserMessage):
+        stream_message = getattr(self._chat, "stream_message", None)
+        if stream_message is None:
+            yield await self.send_message(user_message)
+            return
+        
+        started = time.perf_counter()
+        first_chunk = True
+        try:
+            async for chunk in stream_message(user_message):
+                if first_chunk:
+                    llm_time_to_first_token.observe(self._labels, time.perf_counter() - started)
+                    first_chunk = False
+                yield chunk
+        except Exception:
+            llm_errors_total.inc(self._labels)
+            raise
+        finally:
+            llm_request_duration.observe(self._labels, time.perf_counter() - started)
+
+def scenario_for_llm_call(messages: List[Dict[str, Any]]) -> str:
+    """Label an LLM call by the scenario whose system prompt it carries"""
+    if messages and messages[0].get("role") == "system":
+        return SCENARIO_BY_SYSTEM_PROMPT.get(messages[0].get("content"), "other")
+    return "other"
+
+def record_llm_usage(kwargs: Dict[str, Any], response_obj: Any):
+    usage = getattr(response_obj, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    scenario = scenario_for_llm_call(kwargs.get("messages") or [])
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    prompt_cache_stats.record(scenario, prompt_tokens, cached_tokens)
+    
+    if METRICS_ENABLED:
+        llm_tokens_total.inc((scenario, "prompt"), prompt_tokens)
+        llm_tokens_total.inc((scenario, "cached"), cached_tokens)
+        llm_tokens_total.inc((scenario, "completion"), getattr(usage, "completion_tokens", 0) or 0)
+
+def install_llm_usage_callback():
+    """Register a litellm callback that records prompt token usage"""
+    try:
+        import litellm
+        from litellm.integrations.custom_logger import CustomLogger
+    except ImportError:
+        return
+    
+    class UsageLogger(CustomLogger):
+        async def async_log_success_event(self, kwargs, response_obj, start_time, end_time):
+            record_llm_usage(kwargs, response_obj)
+    
+    litellm.callbacks.append(UsageLogger())
 
 # ========================
 # AUTH ENDPOINTS
@@ -422,22 +3219,21 @@ async def exchange_session(request: Request, response: Response):
         raise HTTPException(status_code=400, detail="session_id is required")
     
     # Call Emergent Auth API
-    async with httpx.AsyncClient() as client:
-        try:
-            auth_response = await client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": session_id}
-            )
-            
-            if auth_response.status_code != 200:
-                raise HTTPException(status_code=401, detail="Invalid session")
-            
-            user_data = auth_response.json()
-            session_data = SessionDataResponse(**user_data)
-            
-        except httpx.RequestError as e:
-            logger.error(f"Auth API error: {e}")
-            raise HTTPException(status_code=500, detail="Auth service error")
+    try:
+        auth_response = await auth_http.client.get(
+            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+            headers={"X-Session-ID": session_id}
+        )
+        
+        if auth_response.status_code != 200:
+            raise HTTPException(status_code=401, detail="Invalid session")
+        
+        user_data = auth_response.json()
+        session_data = SessionDataResponse(**user_data)
+        
+    except httpx.RequestError as e:
+        logger.error(f"Auth API error: {e}")
+        raise HTTPException(status_code=500, detail="Auth service error")
     
     # Create or get user
     user_id = f"user_{uuid.uuid4().hex[:12]}"
@@ -448,6 +3244,7 @@ async def exchange_session(request: Request, response: Response):
     
     if existing_user:
         user_id = existing_user["user_id"]
+        user_doc = existing_user
     else:
         # Create new user
         new_user = {
@@ -458,6 +3255,7 @@ async def exchange_session(request: Request, response: Response):
             "created_at": datetime.now(timezone.utc)
         }
         await db.users.insert_one(new_user)
+        user_doc = new_user
         
         # Initialize user progress
         await db.user_progress.insert_one({
@@ -471,15 +3269,18 @@ async def exchange_session(request: Request, response: Response):
         })
     
     # Create session
-    session_token = session_data.session_token
     expires_at = datetime.now(timezone.utc) + timedelta(days=7)
     
-    await db.user_sessions.insert_one({
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": expires_at,
-        "created_at": datetime.now(timezone.utc)
-    })
+    if AUTH_MODE == "signed":
+        session_token = create_signed_token(user_doc, expires_at)
+    else:
+        session_token = session_data.session_token
+        await db.user_sessions.insert_one({
+            "user_id": user_id,
+            "session_token": session_token,
+            "expires_at": expires_at,
+            "created_at": datetime.now(timezone.utc)
+        })
     
     # Set cookie
     response.set_cookie(
@@ -510,7 +3311,16 @@ async def logout(request: Request, response: Response):
     """Logout user"""
     session_token = await get_session_token_from_request(request)
     if session_token:
-        await db.user_sessions.delete_one({"session_token": session_token})
+        if is_signed_token(session_token):
+            payload = decode_signed_token(session_token)
+            if payload:
+                await revoked_tokens.revoke(
+                    payload["jti"],
+                    datetime.fromtimestamp(payload["exp"], tz=timezone.utc)
+                )
+        else:
+            session_user_cache.invalidate(session_token)
+            await db.user_sessions.delete_one({"session_token": session_token})
     
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Logged out successfully"}
@@ -520,41 +3330,33 @@ async def logout(request: Request, response: Response):
 # ========================
 
 @api_router.get("/quiz/questions")
-async def get_quiz_questions():
+async def get_quiz_questions(request: Request):
     """Get all quiz questions"""
-    return {"questions": QUIZ_QUESTIONS}
+    return QUIZ_QUESTIONS_PAYLOAD.response(request)
 
 @api_router.post("/quiz/submit")
 async def submit_quiz(submission: QuizSubmission, user: User = Depends(require_auth)):
     """Submit quiz and get archetype result"""
     archetype_key = calculate_archetype(submission.answers)
-    archetype_data = ARCHETYPES[archetype_key]
     
     result = QuizResult(
         user_id=user.user_id,
-        archetype=archetype_key,
-        archetype_title=archetype_data["title"],
-        archetype_description=archetype_data["description"],
-        strengths=archetype_data["strengths"],
-        areas_to_improve=archetype_data["areas_to_improve"],
-        recommended_modules=archetype_data["recommended_modules"]
+        **archetype_result_fields(archetype_key)
     )
     
-    # Save result
-    await db.quiz_results.update_one(
-        {"user_id": user.user_id},
-        {"$set": result.dict()},
-        upsert=True
-    )
+    # Save result, keeping the answers so it can be re-scored when weights
+    # change; answer_key is the compact form rescore reads in bulk
+    answers = [answer.dict() for answer in submission.answers]
+    answer_key = quiz_scoring_engine.answer_key(answers)
+    update = {"$set": {**result.dict(), "answers": answers, "updated_at": result.timestamp}}
+    if answer_key is None:
+        update["$unset"] = {"answer_key": ""}
+    else:
+        update["$set"]["answer_key"] = answer_key
+    await db.quiz_results.update_one({"user_id": user.user_id}, update, upsert=True)
     
     # Add XP for completing quiz
-    await db.user_progress.update_one(
-        {"user_id": user.user_id},
-        {
-            "$inc": {"xp": 100},
-            "$set": {"last_activity": datetime.now(timezone.utc)}
-        }
-    )
+    await award_xp(user.user_id, 100)
     
     return result
 
@@ -563,7 +3365,7 @@ async def get_quiz_result(user: User = Depends(require_auth)):
     """Get user's quiz result"""
     result = await db.quiz_results.find_one(
         {"user_id": user.user_id},
-        {"_id": 0}
+        {"_id": 0, "answers": 0, "answer_key": 0}
     )
     if not result:
         return None
@@ -573,6 +3375,44 @@ async def get_quiz_result(user: User = Depends(require_auth)):
 # PROGRESS ENDPOINTS
 # ========================
 
+MS_PER_DAY = 24 * 60 * 60 * 1000
+XP_PER_LEVEL = 500
+
+def with_pending_xp(user_id: str, progress: Dict[str, Any]) -> Dict[str, Any]:
+    """Add XP still buffered on this worker and the level it implies"""
+    progress["xp"] = progress.get("xp", 0) + xp_buffer.pending_xp(user_id)
+    progress["level"] = 1 + progress["xp"] // XP_PER_LEVEL
+    return progress
+
+def progress_update_pipeline(xp_earned: int, now: datetime) -> List[Dict[str, Any]]:
+    """Aggregation-pipeline update that adds XP and recomputes level and streak.
+    
+    Runs server-side in one round trip, so concurrent XP events cannot lose
+    increments. Level goes up every 500 XP; the streak grows when the last
+    activity was one whole day ago and restarts at 1 after a longer gap.
+    """
+    days_since = {"$floor": {"$divide": [{"$subtract": [now, "$last_activity"]}, MS_PER_DAY]}}
+    return [
+        {"$set": {
+            "xp": {"$add": [{"$ifNull": ["$xp", 0]}, xp_earned]},
+            "streak_days": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": [{"$ifNull": ["$last_activity", None]}, None]}, "then": 1},
+                    {"case": {"$eq": [days_since, 1]}, "then": {"$add": [{"$ifNull": ["$streak_days", 0]}, 1]}},
+                    {"case": {"$gt": [days_since, 1]}, "then": 1}
+                ],
+                "default": {"$ifNull": ["$streak_days", 0]}
+            }},
+            "completed_modules": {"$ifNull": ["$completed_modules", []]},
+            "achievements": {"$ifNull": ["$achievements", []]}
+        }},
+        {"$set": {
+            "level": {"$toInt": {"$add": [1, {"$floor": {"$divide": ["$xp", XP_PER_LEVEL]}}]}},
+            "last_activity": now,
+            "updated_at": now
+        }}
+    ]
+
 @api_router.get("/user/progress")
 async def get_progress(user: User = Depends(require_auth)):
     """Get user's progress"""
@@ -589,11 +3429,13 @@ async def get_progress(user: User = Depends(require_auth)):
             "streak_days": 0,
             "last_activity": None,
             "completed_modules": [],
-            "achievements": []
+            "achievements": [],
+            "updated_at": datetime.now(timezone.utc)
         }
         await db.user_progress.insert_one(progress)
     
-    return progress
+    # XP still buffered on this worker has not reached the document yet
+    return with_pending_xp(user.user_id, progress)
 
 @api_router.post("/user/progress/update")
 async def update_progress(
@@ -601,57 +3443,20 @@ async def update_progress(
     user: User = Depends(require_auth)
 ):
     """Update user progress with XP"""
-    progress = await db.user_progress.find_one(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    )
-    
-    if not progress:
-        progress = {
-            "user_id": user.user_id,
-            "xp": 0,
-            "level": 1,
-            "streak_days": 0,
-            "last_activity": None,
-            "completed_modules": [],
-            "achievements": []
-        }
-    
-    new_xp = progress.get("xp", 0) + xp_earned
-    new_level = 1 + (new_xp // 500)  # Level up every 500 XP
-    
-    # Update streak
-    last_activity = progress.get("last_activity")
-    streak_days = progress.get("streak_days", 0)
-    
-    if last_activity:
-        if last_activity.tzinfo is None:
-            last_activity = last_activity.replace(tzinfo=timezone.utc)
-        days_since = (datetime.now(timezone.utc) - last_activity).days
-        if days_since == 1:
-            streak_days += 1
-        elif days_since > 1:
-            streak_days = 1
-    else:
-        streak_days = 1
-    
-    await db.user_progress.update_one(
+    now = datetime.now(timezone.utc)
+    progress = await db.user_progress.find_one_and_update(
         {"user_id": user.user_id},
-        {
-            "$set": {
-                "xp": new_xp,
-                "level": new_level,
-                "streak_days": streak_days,
-                "last_activity": datetime.now(timezone.utc)
-            }
-        },
-        upsert=True
+        progress_update_pipeline(xp_earned, now),
+        projection={"_id": 0, "xp": 1, "level": 1, "streak_days": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
+    with_pending_xp(user.user_id, progress)
     
     return {
-        "xp": new_xp,
-        "level": new_level,
-        "streak_days": streak_days,
+        "xp": progress["xp"],
+        "level": progress["level"],
+        "streak_days": progress["streak_days"],
         "xp_earned": xp_earned
     }
 
@@ -659,14 +3464,38 @@ async def update_progress(
 # FOUNDATION PROTOCOL ENDPOINTS
 # ========================
 
+JOURNAL_ENTRY_FIELDS = ["entry_type", "content", "mood"]
+
 @api_router.get("/foundation/entries")
-async def get_journal_entries(user: User = Depends(require_auth)):
-    """Get user's journal entries"""
-    entries = await db.journal_entries.find(
+async def get_journal_entries(
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX),
+    fields: Optional[str] = None,
+    user: User = Depends(require_auth)
+):
+    """Get user's journal entries, newest first, one keyset page at a time"""
+    entries, next_cursor = await keyset_page(
+        db.journal_entries,
         {"user_id": user.user_id},
+        "entry_id",
+        newest_first=True,
+        before=before,
+        after=after,
+        limit=limit,
+        projection=parse_fields(fields, JOURNAL_ENTRY_FIELDS, ["entry_id", "timestamp"])
+    )
+    return {"entries": entries, "next_cursor": next_cursor}
+
+def journal_entry_xp(entry_type: str) -> int:
+    return 25 if entry_type == "journal" else 15
+
+async def find_entries_by_idempotency_key(user_id: str, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    entries = await db.journal_entries.find(
+        {"user_id": user_id, "idempotency_key": {"$in": keys}},
         {"_id": 0}
-    ).sort("timestamp", -1).to_list(100)
-    return {"entries": entries}
+    ).to_list(None)
+    return {entry["idempotency_key"]: entry for entry in entries}
 
 @api_router.post("/foundation/entries")
 async def create_journal_entry(
@@ -678,67 +3507,99 @@ async def create_journal_entry(
         user_id=user.user_id,
         entry_type=entry.entry_type,
         content=entry.content,
-        mood=entry.mood
+        mood=entry.mood,
+        idempotency_key=entry.idempotency_key
     )
     
-    await db.journal_entries.insert_one(journal_entry.dict())
+    try:
+        await db.journal_entries.insert_one(journal_entry.dict())
+    except DuplicateKeyError:
+        # A replay of an entry that was already saved; no XP the second time
+        existing = await find_entries_by_idempotency_key(user.user_id, [entry.idempotency_key])
+        if entry.idempotency_key not in existing:
+            raise
+        return existing[entry.idempotency_key]
     
     # Add XP for journaling
-    xp_earned = 25 if entry.entry_type == "journal" else 15
-    await db.user_progress.update_one(
-        {"user_id": user.user_id},
-        {
-            "$inc": {"xp": xp_earned},
-            "$set": {"last_activity": datetime.now(timezone.utc)}
-        }
-    )
+    await award_xp(user.user_id, journal_entry_xp(entry.entry_type))
     
     return journal_entry
 
+@api_router.post("/foundation/entries/bulk")
+async def create_journal_entries(
+    bulk: JournalEntryBulkCreate,
+    user: User = Depends(require_auth)
+):
+    """Create several journal entries at once, e.g. when the app comes back online.
+    
+    All new entries go out in one unordered insert_many and their XP in one
+    award. Entries whose idempotency_key was already saved, by an earlier
+    replay or earlier in the same batch, come back as "duplicate" with the
+    stored entry and earn no XP. Every entry gets a status, by position.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(bulk.entries)
+    documents = []
+    positions = []
+    seen_keys = {}
+    for index, entry in enumerate(bulk.entries):
+        if entry.idempotency_key and entry.idempotency_key in seen_keys:
+            results[index] = {"status": "duplicate", "duplicate_of": seen_keys[entry.idempotency_key]}
+            continue
+        if entry.idempotency_key:
+            seen_keys[entry.idempotency_key] = index
+        journal_entry = JournalEntry(
+            user_id=user.user_id,
+            entry_type=entry.entry_type,
+            content=entry.content,
+            mood=entry.mood,
+            idempotency_key=entry.idempotency_key
+        )
+        documents.append(journal_entry.dict())
+        positions.append(index)
+    
+    failed = {}
+    try:
+        await db.journal_entries.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        failed = {error["index"]: error for error in e.details.get("writeErrors", [])}
+    
+    duplicate_keys = [
+        documents[i]["idempotency_key"] for i, error in failed.items()
+        if error["code"] == DUPLICATE_KEY_ERROR and documents[i]["idempotency_key"]
+    ]
+    existing = await find_entries_by_idempotency_key(user.user_id, duplicate_keys) if duplicate_keys else {}
+    
+    xp_earned = 0
+    for i, (document, index) in enumerate(zip(documents, positions)):
+        document.pop("_id", None)
+        error = failed.get(i)
+        if error is None:
+            xp_earned += journal_entry_xp(document["entry_type"])
+            results[index] = {"status": "created", "entry": document}
+        elif document["idempotency_key"] in existing:
+            results[index] = {"status": "duplicate", "entry": existing[document["idempotency_key"]]}
+        else:
+            logger.error(f"Bulk journal insert failed for entry {index}: {error.get('errmsg')}")
+            results[index] = {"status": "error", "detail": "Entry could not be saved"}
+    
+    if xp_earned:
+        await award_xp(user.user_id, xp_earned)
+    
+    return {"results": results, "xp_earned": xp_earned}
+
 @api_router.get("/foundation/prompts")
-async def get_daily_prompts():
+async def get_daily_prompts(request: Request):
     """Get daily journaling prompts"""
-    prompts = {
-        "journal": [
-            "What's one situation this week where you felt confident? Describe it.",
-            "Write about a conversation that didn't go well. What would you do differently?",
-            "Describe your ideal confident self. How does he speak, walk, and interact?",
-            "What fear held you back today? How can you face it tomorrow?",
-            "List 3 things you genuinely like about yourself."
-        ],
-        "affirmation": [
-            "I am worthy of love and respect.",
-            "My confidence grows stronger every day.",
-            "I attract positive, healthy relationships.",
-            "I communicate my thoughts clearly and confidently.",
-            "I am comfortable in my own skin."
-        ],
-        "reflection": [
-            "What did you learn about yourself today?",
-            "How did you step out of your comfort zone?",
-            "What interaction made you proud?",
-            "What's one thing you're grateful for?",
-            "What's your intention for tomorrow?"
-        ]
-    }
-    return prompts
+    return DAILY_PROMPTS_PAYLOAD.response(request)
 
 # ========================
 # CONVERSATION COMBAT ENDPOINTS
 # ========================
 
 @api_router.get("/combat/scenarios")
-async def get_scenarios():
+async def get_scenarios(request: Request):
     """Get available chat scenarios"""
-    scenarios = [
-        {
-            "id": key,
-            "name": data["name"],
-            "description": data["description"]
-        }
-        for key, data in CHAT_SCENARIOS.items()
-    ]
-    return {"scenarios": scenarios}
+    return SCENARIOS_PAYLOAD.response(request)
 
 @api_router.post("/combat/chat")
 async def chat_with_ai(
@@ -753,75 +3614,26 @@ async def chat_with_ai(
     session_id = chat_request.session_id or str(uuid.uuid4())
     
     # Get conversation history
-    history = await db.chat_messages.find(
-        {
-            "user_id": user.user_id,
-            "session_id": session_id
-        },
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(50)
+    history = await get_session_history(user.user_id, session_id)
+    state = await get_session_state(user.user_id, session_id)
     
-    # Build messages for LLM
-    try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=session_id,
-            system_message=scenario["system_prompt"]
-        )
-        chat.with_model("openai", "gpt-4.1")
-        
-        # Add history context
-        context = ""
-        if history:
-            context = "Previous conversation:\n"
-            for msg in history[-10:]:  # Last 10 messages
-                role = "User" if msg["role"] == "user" else "Her"
-                context += f"{role}: {msg['content']}\n"
-            context += "\nContinue the conversation:\n"
-        
-        user_message = UserMessage(text=context + chat_request.message if context else chat_request.message)
-        response_text = await chat.send_message(user_message)
-        
-    except Exception as e:
-        logger.error(f"LLM error: {e}")
-        # Fallback response
-        response_text = "Sorry, I'm a bit distracted right now. Can you say that again? [Feedback: Keep practicing! The AI service had a temporary issue.]"
-    
-    # Extract feedback if present
-    feedback = None
-    main_response = response_text
-    if "[Feedback:" in response_text:
-        parts = response_text.split("[Feedback:")
-        main_response = parts[0].strip()
-        feedback = parts[1].replace("]", "").strip() if len(parts) > 1 else None
-    
-    # Save messages
-    user_msg = ChatMessage(
-        user_id=user.user_id,
-        session_id=session_id,
-        role="user",
-        content=chat_request.message,
-        scenario=chat_request.scenario
-    )
-    await db.chat_messages.insert_one(user_msg.dict())
+    cache_key = response_cache.key_for(chat_request.scenario, chat_request.message, history, state)
+    response_text = await response_cache.get(cache_key, chat_request.scenario) if cache_key else None
     
-    assistant_msg = ChatMessage(
-        user_id=user.user_id,
-        session_id=session_id,
-        role="assistant",
-        content=main_response,
-        scenario=chat_request.scenario
-    )
-    await db.chat_messages.insert_one(assistant_msg.dict())
+    if response_text is None:
+        try:
+            chat, user_message = prepare_chat(session_id, scenario, history, chat_request.message, state)
+            response_text = await chat.send_message(user_message)
+            if cache_key:
+                await response_cache.set(cache_key, chat_request.scenario, response_text)
+        except Exception as e:
+            logger.error(f"LLM error: {e}")
+            response_text = LLM_FALLBACK_RESPONSE
     
-    # Add XP for practicing
-    await db.user_progress.update_one(
-        {"user_id": user.user_id},
-        {
-            "$inc": {"xp": 10},
-            "$set": {"last_activity": datetime.now(timezone.utc)}
-        }
-    )
+    main_response, feedback = split_feedback(response_text)
+    
+    messages = await save_chat_turn(user, session_id, chat_request, main_response)
+    maybe_summarize_session(user.user_id, session_id, history + messages, state)
     
     return ChatResponse(
         response=main_response,
@@ -829,26 +3641,607 @@ async def chat_with_ai(
         feedback=feedback
     )
 
+@api_router.post("/combat/chat/stream")
+async def stream_chat_with_ai(
+    chat_request: ChatRequest,
+    user: User = Depends(require_auth)
+):
+    """Chat with AI, streaming the reply as Server-Sent Events.
+    
+    Emits a "session" event, then "token" events as text arrives, a
+    "feedback" event once the coaching section is complete and a final
+    "done" event. Messages are saved only after the stream finishes.
+    """
+    scenario = CHAT_SCENARIOS.get(chat_request.scenario)
+    if not scenario:
+        raise HTTPException(status_code=400, detail="Invalid scenario")
+    
+    session_id = chat_request.session_id or str(uuid.uuid4())
+    history = await get_session_history(user.user_id, session_id)
+    
+    async def event_stream():
+        yield sse_event("session", {"session_id": session_id})
+        async for event, data in stream_chat_turn(user, session_id, chat_request, scenario, history):
+            yield sse_event(event, data)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+class CombatSocket:
+    """A Conversation Combat session over one WebSocket connection"""
+
+    def __init__(self, websocket: WebSocket, user: User, session_id: str, scenario_key: str):
+        self.websocket = websocket
+        self.user = user
+        self.session_id = session_id
+        self.scenario_key = scenario_key
+        self.scenario = CHAT_SCENARIOS[scenario_key]
+        self.history: List[Dict[str, Any]] = []
+        self.pending: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_PENDING_MESSAGES)
+        self.last_seen = time.monotonic()
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, message_type: str, data: Optional[Dict[str, Any]] = None):
+        async with self._send_lock:
+            await asyncio.wait_for(
+                self.websocket.send_json({"type": message_type, **(data or {})}),
+                timeout=WS_SEND_TIMEOUT_SECONDS
+            )
+
+    async def receive_loop(self):
+        while True:
+            frame = await self.websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", status.WS_1000_NORMAL_CLOSURE))
+            self.last_seen = time.monotonic()
+            
+            # Malformed frames get an error event rather than closing the socket
+            try:
+                message = json.loads(frame.get("text") or frame.get("bytes") or "")
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                await self.send("error", {"detail": "Invalid message"})
+                continue
+            message_type = message.get("type")
+            
+            if message_type == "ping":
+                await self.send("pong")
+            elif message_type == "pong":
+                continue
+            elif message_type == "message" and isinstance(message.get("message"), str) and message["message"]:
+                try:
+                    self.pending.put_nowait(message["message"])
+                except asyncio.QueueFull:
+                    await self.send("error", {"detail": "busy"})
+            else:
+                await self.send("error", {"detail": "Invalid message"})
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+            if time.monotonic() - self.last_seen > WS_IDLE_TIMEOUT_SECONDS:
+                await self.websocket.close(code=status.WS_1001_GOING_AWAY)
+                return
+            await self.send("ping")
+
+    async def turn_loop(self):
+        while True:
+            message = await self.pending.get()
+            chat_request = ChatRequest(
+                message=message,
+                scenario=self.scenario_key,
+                session_id=self.session_id
+            )
+            async for event, data in stream_chat_turn(self.user, self.session_id, chat_request, self.scenario, self.history):
+                await self.send(event, data)
+            del self.history[:-50]
+
+    async def run(self):
+        self.history = await get_session_history(self.user.user_id, self.session_id)
+        await self.send("session", {"session_id": self.session_id})
+        
+        tasks = [
+            asyncio.create_task(self.receive_loop()),
+            asyncio.create_task(self.heartbeat_loop()),
+            asyncio.create_task(self.turn_loop())
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+@api_router.websocket("/combat/ws/{session_id}")
+async def combat_socket(websocket: WebSocket, session_id: str, scenario: str):
+    """Conversation Combat session over a WebSocket"""
+    if scenario not in CHAT_SCENARIOS:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    user = await get_current_user(websocket)
+    if not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    try:
+        await CombatSocket(websocket, user, session_id, scenario).run()
+    except (WebSocketDisconnect, asyncio.TimeoutError):
+        pass
+
+CHAT_MESSAGE_FIELDS = ["role", "content", "scenario"]
+
 @api_router.get("/combat/history/{session_id}")
 async def get_chat_history(
     session_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX),
+    fields: Optional[str] = None,
     user: User = Depends(require_auth)
 ):
-    """Get chat history for a session"""
-    messages = await db.chat_messages.find(
+    """Get chat history for a session, oldest first, one keyset page at a time"""
+    first_page = not before and not after and not fields
+    if first_page and HISTORY_CACHE_ENABLED:
+        entry = session_history_cache.get(user.user_id, session_id)
+        if entry and entry["complete"]:
+            messages = list(entry["messages"])
+            next_cursor = encode_cursor(messages[limit - 1], "message_id") if len(messages) > limit else None
+            return {"messages": messages[:limit], "next_cursor": next_cursor}
+    
+    messages, next_cursor = await keyset_page(
+        db.chat_messages,
         {
             "user_id": user.user_id,
             "session_id": session_id
         },
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(100)
-    return {"messages": messages}
+        "message_id",
+        newest_first=False,
+        before=before,
+        after=after,
+        limit=limit,
+        projection=parse_fields(fields, CHAT_MESSAGE_FIELDS, ["message_id", "timestamp"]),
+        pending=chat_write_queue.pending_messages(user.user_id, session_id)
+    )
+    
+    if first_page and next_cursor is None:
+        if HISTORY_CACHE_ENABLED and limit == PAGE_SIZE_MAX and len(messages) < HISTORY_CACHE_MESSAGES_PER_SESSION:
+            session_history_cache.load(user.user_id, session_id, messages, complete=True)
+    return {"messages": messages, "next_cursor": next_cursor}
 
 @api_router.post("/combat/new-session")
 async def start_new_session(user: User = Depends(require_auth)):
     """Start a new chat session"""
     return {"session_id": str(uuid.uuid4())}
 
+# ========================
+# DASHBOARD ENDPOINTS
+# ========================
+
+async def dashboard_progress(user_id: str) -> Dict[str, Any]:
+    progress = await db.user_progress.find_one(
+        {"user_id": user_id},
+        {"_id": 0, "xp": 1, "level": 1, "streak_days": 1, "last_activity": 1}
+    ) or {"xp": 0, "level": 1, "streak_days": 0, "last_activity": None}
+    return with_pending_xp(user_id, progress)
+
+async def dashboard_quiz_result(user_id: str) -> Optional[Dict[str, Any]]:
+    return await db.quiz_results.find_one(
+        {"user_id": user_id},
+        {"_id": 0, "archetype": 1, "archetype_title": 1, "recommended_modules": 1}
+    )
+
+async def dashboard_recent_entries(user_id: str) -> Dict[str, Any]:
+    entries, next_cursor = await keyset_page(
+        db.journal_entries,
+        {"user_id": user_id},
+        "entry_id",
+        newest_first=True,
+        before=None,
+        after=None,
+        limit=DASHBOARD_RECENT_ENTRIES,
+        projection={"_id": 0, "entry_id": 1, "entry_type": 1, "content": 1, "mood": 1, "timestamp": 1}
+    )
+    return {"entries": entries, "next_cursor": next_cursor}
+
+async def dashboard_recent_sessions(user_id: str) -> List[Dict[str, Any]]:
+    """Latest chat sessions, grouped from the most recent messages only.
+    
+    Scanning a bounded window off the (user_id, timestamp) index keeps the
+    cost flat however much chat history the user has.
+    """
+    sessions = await db.chat_messages.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"timestamp": -1, "message_id": -1}},
+        {"$limit": DASHBOARD_SESSION_SCAN_MESSAGES},
+        {"$group": {
+            "_id": "$session_id",
+            "scenario": {"$first": "$scenario"},
+            "last_message": {"$first": "$content"},
+            "last_message_at": {"$first": "$timestamp"}
+        }},
+        {"$sort": {"last_message_at": -1}},
+        {"$limit": DASHBOARD_RECENT_SESSIONS},
+        {"$project": {"_id": 0, "session_id": "$_id", "scenario": 1, "last_message": 1, "last_message_at": 1}}
+    ]).to_list(DASHBOARD_RECENT_SESSIONS)
+    for session in sessions:
+        session["last_message"] = session["last_message"][:120]
+    return sessions
+
+@api_router.get("/dashboard")
+async def get_dashboard(user: User = Depends(require_auth)):
+    """Everything the dashboard shows on launch, in one authenticated call"""
+    progress, quiz_result, journal, sessions = await asyncio.gather(
+        dashboard_progress(user.user_id),
+        dashboard_quiz_result(user.user_id),
+        dashboard_recent_entries(user.user_id),
+        dashboard_recent_sessions(user.user_id)
+    )
+    return {
+        "user": {"user_id": user.user_id, "name": user.name, "picture": user.picture},
+        "progress": progress,
+        "quiz_result": quiz_result,
+        "recent_entries": journal["entries"],
+        "entries_cursor": journal["next_cursor"],
+        "recent_sessions": sessions
+    }
+
+# ========================
+# SYNC ENDPOINTS
+# ========================
+
+# collection: (change timestamp field, id field, projection)
+SYNC_COLLECTIONS = {
+    "journal_entries": ("timestamp", "entry_id", {"_id": 0, "user_id": 0}),
+    "chat_messages": ("timestamp", "message_id", {"_id": 0, "user_id": 0}),
+    "user_progress": ("updated_at", "user_id", {"_id": 0}),
+    "quiz_results": ("updated_at", "user_id", {"_id": 0, "answers": 0, "answer_key": 0}),
+}
+
+async def sync_collection(
+    user_id: str,
+    name: str,
+    watermark: Optional[str],
+    limit: int,
+    settle_at: datetime
+) -> Dict[str, Any]:
+    """Documents of one collection changed after a watermark, in (timestamp, id) order"""
+    timestamp_field, id_field, projection = SYNC_COLLECTIONS[name]
+    query = {"user_id": user_id}
+    since = None
+    if watermark:
+        since, last_id = decode_cursor(watermark)
+        query["$or"] = [
+            {timestamp_field: {"$gt": since}},
+            {timestamp_field: since, id_field: {"$gt": last_id}}
+        ]
+    
+    docs = await db[name].find(query, projection).sort(
+        [(timestamp_field, ASCENDING), (id_field, ASCENDING)]
+    ).to_list(limit + 1)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    
+    # Watermarks trail the clock by SYNC_SETTLE_SECONDS so late writes (the
+    # chat write queue, buffered XP, other workers) are caught next time
+    if has_more:
+        next_watermark = encode_cursor(docs[-1], id_field, timestamp_field)
+    elif since is not None and since >= settle_at:
+        next_watermark = watermark
+    else:
+        next_watermark = encode_cursor({timestamp_field: settle_at, id_field: ""}, id_field, timestamp_field)
+    
+    if name == "user_progress":
+        # XP still buffered on this worker has not reached the document yet
+        for doc in docs:
+            with_pending_xp(user_id, doc)
+    
+    return {
+        "changes": docs,
+        "watermark": next_watermark,
+        "has_more": has_more
+    }
+
+@api_router.post("/sync")
+async def sync(sync_request: SyncRequest, user: User = Depends(require_auth)):
+    """Return what changed since the client's per-collection watermarks.
+    
+    Collections without a watermark are downloaded in full. Only collections
+    with changes appear in the payload; the client stores the returned
+    watermarks and calls again while has_more is true.
+    """
+    unknown = [name for name in sync_request.watermarks if name not in SYNC_COLLECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown collections: {', '.join(unknown)}")
+    
+    settle_at = datetime.now(timezone.utc) - timedelta(seconds=SYNC_SETTLE_SECONDS)
+    names = list(SYNC_COLLECTIONS)
+    results = await asyncio.gather(*[
+        sync_collection(user.user_id, name, sync_request.watermarks.get(name), sync_request.limit, settle_at)
+        for name in names
+    ])
+    
+    response = {"changes": {}, "watermarks": {}, "has_more": False}
+    for name, result in zip(names, results):
+        if result["changes"]:
+            response["changes"][name] = result["changes"]
+        response["watermarks"][name] = result["watermark"]
+        response["has_more"] = response["has_more"] or result["has_more"]
+    return response
+
+# ========================
+# BATCH ENDPOINTS
+# ========================
+
+BATCH_METHODS = {"GET", "POST", "PUT", "PATCH", "DELETE"}
+
+# Sub-responses must come back as plain JSON, never gzip or 304
+BATCH_DROPPED_HEADERS = {b"content-length", b"content-type", b"accept-encoding", b"if-none-match"}
+
+async def run_batch_item(request: Request, user: User, item: BatchRequestItem) -> Dict[str, Any]:
+    """Run one sub-request through the app in-process and capture its response.
+    
+    The sub-request goes through the same middleware, routing, validation and
+    exception handlers as a real request, but carries the batch's User in its
+    scope so get_current_user does not authenticate it again.
+    """
+    method = item.method.upper()
+    path, _, query_string = item.path.partition("?")
+    if method not in BATCH_METHODS:
+        return {"status": 405, "body": {"detail": f"Method {item.method} not allowed"}}
+    if not path.startswith("/api/") or path.rstrip("/") == "/api/batch":
+        return {"status": 400, "body": {"detail": "Path must be an /api route other than /api/batch"}}
+    
+    body = b""
+    headers = [(name, value) for name, value in request.scope["headers"] if name not in BATCH_DROPPED_HEADERS]
+    if item.body is not None:
+        body = json.dumps(item.body).encode()
+        headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    
+    scope = {
+        "type": "http",
+        "asgi": request.scope.get("asgi", {"version": "3.0"}),
+        "http_version": request.scope.get("http_version", "1.1"),
+        "method": method,
+        "scheme": request.scope.get("scheme", "http"),
+        "server": request.scope.get("server"),
+        "client": request.scope.get("client"),
+        "root_path": request.scope.get("root_path", ""),
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string.encode(),
+        "headers": headers,
+        "batch_user": user,
+    }
+    
+    finished = asyncio.Event()
+    body_sent = False
+    
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Streaming responses listen for a disconnect; only send it at the end
+        await finished.wait()
+        return {"type": "http.disconnect"}
+    
+    response = {"status": 500, "content_type": "", "chunks": []}
+    
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            for name, value in message.get("headers", []):
+                if name.lower() == b"content-type":
+                    response["content_type"] = value.decode("latin-1")
+        elif message["type"] == "http.response.body":
+            response["chunks"].append(message.get("body", b""))
+    
+    try:
+        await app(scope, receive, send)
+    except Exception as e:
+        logger.error(f"Batch sub-request {method} {path} failed: {e}")
+        return {"status": 500, "body": {"detail": "Internal Server Error"}}
+    finally:
+        finished.set()
+    
+    content = b"".join(response["chunks"])
+    if response["content_type"].startswith("application/json") and content:
+        result_body = json.loads(content)
+    else:
+        result_body = content.decode("utf-8", errors="replace")
+    return {"status": response["status"], "body": result_body}
+
+@api_router.post("/batch")
+async def batch(batch_request: BatchRequest, request: Request, user: User = Depends(require_auth)):
+    """Run several /api requests in one round trip, with one status per item.
+    
+    Requests run in the order given. Consecutive GETs are independent reads
+    and run concurrently; any other method runs on its own, so a read after
+    a write sees that write.
+    """
+    items = batch_request.requests
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    
+    start = 0
+    while start < len(items):
+        end = start + 1
+        if items[start].method.upper() == "GET":
+            while end < len(items) and items[end].method.upper() == "GET":
+                end += 1
+        results[start:end] = await asyncio.gather(*[
+            run_batch_item(request, user, item) for item in items[start:end]
+        ])
+        start = end
+    
+    return {"results": results}
+
+# ========================
+# METRICS AND ADMIN ENDPOINTS
+# ========================
+
+def is_internal_request(request: HTTPConnection) -> bool:
+    """True for direct connections from METRICS_ALLOWED_NETWORKS.
+    
+    Requests that came through the ingress carry forwarding headers, so
+    those are refused even when the proxy itself is on an internal network.
+    """
+    if any(header in request.headers for header in ("x-forwarded-for", "x-real-ip", "forwarded")):
+        return False
+    if request.client is None:
+        return False
+    try:
+        address = ipaddress.ip_address(request.client.host)
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+async def require_internal(request: Request):
+    """Dependency that hides an endpoint from anything but internal callers"""
+    if not is_internal_request(request):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+def render_component_stats() -> List[str]:
+    """The in-process caches, queues and pools as gauges, grouped per metric"""
+    families: Dict[str, List[str]] = {}
+    
+    def add(component: str, stats: Dict[str, Any], labels: Optional[Dict[str, str]] = None):
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                name = f"rizz_{component}_{key}"
+                families.setdefault(name, []).append(f"{name}{format_labels(labels or {})} {value}")
+    
+    add("auth_cache", session_user_cache.stats())
+    for pool in (auth_http, llm_http):
+        add("http_pool", pool.stats(), {"pool": pool.name})
+    add("write_queue", chat_write_queue.stats())
+    add("history_cache", session_history_cache.stats())
+    response_stats = response_cache.stats()
+    add("response_cache", response_stats)
+    for scenario, stats in response_stats["scenarios"].items():
+        add("response_cache_scenario", stats, {"scenario": scenario})
+    for scenario, stats in prompt_cache_stats.stats().items():
+        add("prompt_cache", stats, {"scenario": scenario})
+    add("xp_buffer", xp_buffer.stats())
+    if LLM_MODE != "live":
+        add("llm_replay", llm_recordings.stats(), {"mode": LLM_MODE})
+    
+    lines = []
+    for name, samples in families.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines += samples
+    return lines
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def metrics():
+    """Prometheus scrape endpoint, outside /api so the ingress never routes to it"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    
+    lines = []
+    for metric in REQUEST_METRICS + MONGO_METRICS + LLM_METRICS:
+        lines += metric.render()
+    lines += render_component_stats()
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.post("/admin/profiler", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def start_profiler_window(
+    seconds: float = Query(30, gt=0, le=PROFILER_MAX_WINDOW_SECONDS),
+    path_prefix: str = "/api/"
+):
+    """Profile every request under path_prefix for the next few seconds"""
+    profile = request_profiler.start_window(seconds, path_prefix)
+    return {"profile_id": profile.profile_id, "seconds": seconds, "path_prefix": path_prefix}
+
+@app.delete("/admin/profiler", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def stop_profiler_window():
+    profile = request_profiler.stop_window()
+    return profile.summary() if profile else None
+
+@app.get("/admin/profiles", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def list_profiles():
+    request_profiler.expire_window()
+    profiles = list(request_profiler.profiles.values())
+    if request_profiler.window is not None:
+        profiles.append(request_profiler.window)
+    return {"profiles": [profile.summary() for profile in reversed(profiles)]}
+
+@app.get("/admin/profiles/{profile_id}", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def get_profile(profile_id: str):
+    """Folded stacks for flamegraph.pl, speedscope or inferno"""
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(profile.folded(), media_type="text/plain")
+
+MEMORY_GROUP_BY_PATTERN = "^(" + "|".join(MEMORY_GROUPINGS) + ")$"
+
+@app.get("/admin/memory", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def get_memory_status():
+    return memory_accounting.status()
+
+@app.post("/admin/memory/tracing", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def start_memory_tracing(frames: int = Query(MEMORY_TRACE_FRAMES, ge=1, le=50)):
+    """Start tracemalloc; allocations get slower until it is stopped"""
+    memory_accounting.start_tracing(frames)
+    return memory_accounting.status()
+
+@app.delete("/admin/memory/tracing", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def stop_memory_tracing():
+    memory_accounting.stop_tracing()
+    return memory_accounting.status()
+
+@app.post("/admin/memory/snapshots", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def take_memory_snapshot():
+    return memory_accounting.snapshot_summary(memory_accounting.take_snapshot())
+
+@app.get("/admin/memory/snapshots/{snapshot_id}", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def get_memory_snapshot(
+    snapshot_id: str,
+    group_by: str = Query("line", pattern=MEMORY_GROUP_BY_PATTERN),
+    limit: int = Query(25, ge=1, le=500)
+):
+    """Biggest allocation sites in a snapshot"""
+    return {
+        **memory_accounting.snapshot_summary(memory_accounting.get_snapshot(snapshot_id)),
+        "top": memory_accounting.top(snapshot_id, group_by, limit)
+    }
+
+@app.get("/admin/memory/snapshots/{snapshot_id}/diff", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def diff_memory_snapshots(
+    snapshot_id: str,
+    base: str,
+    group_by: str = Query("line", pattern=MEMORY_GROUP_BY_PATTERN),
+    limit: int = Query(25, ge=1, le=500)
+):
+    """What grew between the base snapshot and this one, biggest growth first"""
+    return {
+        "base": memory_accounting.snapshot_summary(memory_accounting.get_snapshot(base)),
+        "current": memory_accounting.snapshot_summary(memory_accounting.get_snapshot(snapshot_id)),
+        "top": memory_accounting.diff(snapshot_id, base, group_by, limit)
+    }
+
+@app.post("/admin/memory/routes", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def start_memory_route_window(
+    seconds: float = Query(60, gt=0, le=MEMORY_MAX_WINDOW_SECONDS),
+    sample_rate: float = Query(0.1, gt=0, le=1)
+):
+    """Measure allocated and retained bytes per route for sampled requests"""
+    memory_accounting.start_window(seconds, sample_rate)
+    return memory_accounting.window_summary()
+
+@app.get("/admin/memory/routes", include_in_schema=False, dependencies=[Depends(require_internal)])
+async def get_memory_routes():
+    return memory_accounting.window_summary()
+
 # ========================
 # GENERAL ENDPOINTS
 # ========================
@@ -864,6 +4257,12 @@ async def health():
 # Include the router
 app.include_router(api_router)
 
+app.add_middleware(MemoryAccountingMiddleware)
+app.add_middleware(ProfilerMiddleware)
+
+if METRICS_ENABLED:
+    app.add_middleware(RequestMetricsMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -873,6 +4272,88 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+async def refresh_revoked_tokens():
+    """Periodically reload the signed-token denylist from Mongo"""
+    while True:
+        await asyncio.sleep(REVOKED_TOKEN_REFRESH_SECONDS)
+        try:
+            await revoked_tokens.load()
+        except Exception as e:
+            logger.error(f"Revoked token refresh error: {e}")
+
+background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def startup_http_clients():
+    auth_http.open()
+    install_llm_http_client(llm_http.open())
+    install_llm_usage_callback()
+
+@app.on_event("startup")
+async def startup_tokenizer():
+    await startup_token_encoding()
+
+@app.on_event("startup")
+async def startup_llm_replay():
+    if LLM_MODE == "replay":
+        llm_recordings.load(LLM_RECORDING_FILE)
+
+@app.on_event("startup")
+async def startup_write_queue():
+    if WRITE_QUEUE_ENABLED:
+        chat_write_queue.start()
+
+@app.on_event("startup")
+async def startup_xp_buffer():
+    if XP_BUFFER_ENABLED:
+        xp_buffer.start()
+
+@app.on_event("startup")
+async def startup_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def startup_auth():
+    if AUTH_TOKEN_SECRET:
+        await revoked_tokens.load()
+        background_tasks.append(asyncio.create_task(refresh_revoked_tokens()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await chat_write_queue.close()
+    await xp_buffer.close()
+    install_llm_http_client(None)
+    await auth_http.close()
+    await llm_http.close()
     client.close()
+
+async def run_cli(args: argparse.Namespace) -> int:
+    if args.command == "indexes":
+        await ensure_indexes()
+        print("Indexes are up to date")
+        return 0
+    
+    if args.command == "rescore":
+        counts = await rescore_quiz_results(load_scoring_engine(), args.batch_size)
+        print(f"Re-scored {counts['scanned']} quiz results, {counts['changed']} changed archetype")
+        return 0
+    
+    if args.command == "bench-quiz":
+        print(json.dumps(benchmark_quiz_scoring(args.submissions), indent=2))
+        return 0
+    
+    return 0 if await explain_hot_queries() else 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rizz Academy API maintenance commands")
+    parser.add_argument(
+        "command",
+        choices=["indexes", "explain", "rescore", "bench-quiz"],
+        help="create the required indexes, explain() the hot queries, re-score stored quiz results or benchmark quiz scoring"
+    )
+    parser.add_argument("--batch-size", type=int, default=QUIZ_RESCORE_BATCH_SIZE, help="quiz results per re-score batch")
+    parser.add_argument("--submissions", type=int, default=100_000, help="submissions for bench-quiz")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run_cli(args)))
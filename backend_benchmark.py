@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Rizz Academy Backend Load Test and Benchmark
+Boots server.app in-process against a local mongod (or an in-memory stand-in)
+and a fake LlmChat, drives concurrent virtual users through a route mix and
+reports RPS plus p50/p95/p99 latency per route. Results are saved as JSON so
+runs can be diffed between commits.
+
+    python backend_benchmark.py --users 50 --duration 30 --mix default
+    python backend_benchmark.py --mongo-url mongodb://localhost:27017 --mix combat
+    python backend_benchmark.py --mix combat --llm-recording backend/llm_recordings.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+ROOT_DIR = Path(__file__).parent
+BACKEND_DIR = ROOT_DIR / "backend"
+
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+
+# ========================
+# FAKE LLM
+# ========================
+
+class FakeLlmChat:
+    """Stand-in for LlmChat that answers after a configurable delay.
+
+    send_message() sleeps for latency +/- jitter; stream_message() spreads
+    the same reply over per-token delays so the streaming routes see a
+    realistic time to first token.
+    """
+
+    latency = 0.8
+    jitter = 0.2
+    tokens_per_second = 50.0
+    reply = ("Haha, that's a fun way to start. So what brings you here today? "
+             "[Feedback: Good opener, light and playful. Score: 7/10]")
+
+    def __init__(self, api_key, session_id, system_message, initial_messages=None):
+        self.session_id = session_id
+        self.system_message = system_message
+        self.messages = list(initial_messages or [])
+
+    def with_model(self, provider, model):
+        self.provider = provider
+        self.model = model
+        return self
+
+    def _delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    async def send_message(self, user_message):
+        await asyncio.sleep(self._delay())
+        return self.reply
+
+    async def stream_message(self, user_message):
+        tokens = self.reply.split(" ")
+        first_token = max(0.0, self._delay() - len(tokens) / self.tokens_per_second)
+        await asyncio.sleep(first_token)
+        for i, token in enumerate(tokens):
+            yield token if i == 0 else " " + token
+            await asyncio.sleep(1 / self.tokens_per_second)
+
+# ========================
+# APP BOOTSTRAP
+# ========================
+
+def load_server(args):
+    """Import server.py against the chosen database with the fake LLM"""
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_name
+    if args.llm_recording:
+        # Recorded exchanges replace the fake; LLM_REPLAY_* tune errors and timing
+        os.environ["LLM_MODE"] = "replay"
+        os.environ["LLM_RECORDING_FILE"] = args.llm_recording
+
+    if not args.mongo_url:
+        try:
+            import mongomock_motor
+        except ImportError:
+            sys.exit("In-memory mode needs mongomock-motor (pip install mongomock-motor), or pass --mongo-url")
+        import motor.motor_asyncio
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    if not args.llm_recording:
+        server.LlmChat = FakeLlmChat
+    return server
+
+async def seed_users(server, users: int):
+    """Create one user, session and progress document per virtual user"""
+    now = datetime.now(timezone.utc)
+    tokens = []
+    for i in range(users):
+        user_id = f"bench_user_{i}"
+        token = f"bench_token_{i}_{uuid.uuid4().hex}"
+        await server.db.users.update_one(
+            {"user_id": user_id},
+            {"$set": {"user_id": user_id, "email": f"{user_id}@bench.local", "name": f"Bench {i}", "picture": None, "created_at": now}},
+            upsert=True
+        )
+        await server.db.user_sessions.insert_one({
+            "user_id": user_id,
+            "session_token": token,
+            "expires_at": now + timedelta(days=1),
+            "created_at": now
+        })
+        await server.db.user_progress.update_one(
+            {"user_id": user_id},
+            {"$setOnInsert": {"xp": 0, "level": 1, "streak_days": 0, "last_activity": None, "completed_modules": [], "achievements": []}},
+            upsert=True
+        )
+        tokens.append(token)
+    return tokens
+
+# ========================
+# ROUTE MIXES
+# ========================
+
+# WebSocket chat, /auth/session (calls the external auth service) and
+# /auth/logout (ends the virtual user's session) are not part of the mixes.
+
+class VirtualUser:
+    def __init__(self, server, http: httpx.AsyncClient, token: str, rng: random.Random):
+        self.server = server
+        self.http = http
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.rng = rng
+        self.session_id = None
+        self.scenario = rng.choice(list(server.CHAT_SCENARIOS))
+
+    async def get(self, path):
+        return await self.http.get(path, headers=self.headers)
+
+    async def post(self, path, body=None):
+        return await self.http.post(path, headers=self.headers, json=body)
+
+    def quiz_answers(self):
+        return [
+            {"question_id": question["id"], "answer": self.rng.choice(self.server.OPTION_VALUES)}
+            for question in self.server.QUIZ_QUESTIONS
+        ]
+
+    def journal_entry(self):
+        entry_type = self.rng.choice(["journal", "affirmation", "reflection"])
+        return {"entry_type": entry_type, "content": f"Benchmark {entry_type} {self.rng.random():.6f}", "mood": "good"}
+
+    async def chat(self):
+        body = {"message": self.rng.choice(["Hey!", "What are you reading?", "Is this seat taken?"]), "scenario": self.scenario}
+        if self.session_id:
+            body["session_id"] = self.session_id
+        response = await self.post("/api/combat/chat", body)
+        if response.status_code == 200:
+            self.session_id = response.json()["session_id"]
+        return response
+
+    async def chat_stream(self):
+        body = {"message": "Tell me more about that", "scenario": self.scenario}
+        if self.session_id:
+            body["session_id"] = self.session_id
+        return await self.post("/api/combat/chat/stream", body)
+
+    async def history(self):
+        if not self.session_id:
+            await self.chat()
+        return await self.get(f"/api/combat/history/{self.session_id}?limit=20")
+
+    async def new_session(self):
+        response = await self.post("/api/combat/new-session")
+        if response.status_code == 200:
+            self.session_id = None
+        return response
+
+# (route label, action)
+ROUTES = {
+    "GET /api/": lambda u: u.get("/api/"),
+    "GET /api/health": lambda u: u.get("/api/health"),
+    "GET /api/auth/me": lambda u: u.get("/api/auth/me"),
+    "GET /api/quiz/questions": lambda u: u.get("/api/quiz/questions"),
+    "POST /api/quiz/submit": lambda u: u.post("/api/quiz/submit", {"answers": u.quiz_answers()}),
+    "GET /api/quiz/result": lambda u: u.get("/api/quiz/result"),
+    "GET /api/user/progress": lambda u: u.get("/api/user/progress"),
+    "POST /api/user/progress/update": lambda u: u.post("/api/user/progress/update?xp_earned=5"),
+    "GET /api/foundation/entries": lambda u: u.get("/api/foundation/entries?limit=20"),
+    "POST /api/foundation/entries": lambda u: u.post("/api/foundation/entries", u.journal_entry()),
+    "POST /api/foundation/entries/bulk": lambda u: u.post("/api/foundation/entries/bulk", {"entries": [u.journal_entry() for _ in range(5)]}),
+    "GET /api/foundation/prompts": lambda u: u.get("/api/foundation/prompts"),
+    "GET /api/combat/scenarios": lambda u: u.get("/api/combat/scenarios"),
+    "POST /api/combat/chat": lambda u: u.chat(),
+    "POST /api/combat/chat/stream": lambda u: u.chat_stream(),
+    "GET /api/combat/history/{session_id}": lambda u: u.history(),
+    "POST /api/combat/new-session": lambda u: u.new_session(),
+    "GET /api/dashboard": lambda u: u.get("/api/dashboard"),
+    "POST /api/sync": lambda u: u.post("/api/sync", {"watermarks": {}}),
+    "POST /api/batch": lambda u: u.post("/api/batch", {"requests": [
+        {"path": "/api/user/progress"}, {"path": "/api/quiz/result"}, {"path": "/api/foundation/entries?limit=5"}
+    ]}),
+}
+
+# Relative weights per route; routes left out of a mix are not called
+MIXES = {
+    "default": {
+        "GET /api/": 1, "GET /api/health": 1, "GET /api/auth/me": 5,
+        "GET /api/quiz/questions": 3, "POST /api/quiz/submit": 1, "GET /api/quiz/result": 4,
+        "GET /api/user/progress": 8, "POST /api/user/progress/update": 2,
+        "GET /api/foundation/entries": 8, "POST /api/foundation/entries": 4, "POST /api/foundation/entries/bulk": 1,
+        "GET /api/foundation/prompts": 4, "GET /api/combat/scenarios": 4,
+        "POST /api/combat/chat": 6, "POST /api/combat/chat/stream": 2, "GET /api/combat/history/{session_id}": 4,
+        "POST /api/combat/new-session": 1, "GET /api/dashboard": 4, "POST /api/sync": 2, "POST /api/batch": 2,
+    },
+    "combat": {
+        "GET /api/combat/scenarios": 2, "POST /api/combat/new-session": 1,
+        "POST /api/combat/chat": 10, "POST /api/combat/chat/stream": 5, "GET /api/combat/history/{session_id}": 4,
+        "GET /api/user/progress": 2,
+    },
+    "cold-start": {
+        "GET /api/auth/me": 2, "GET /api/dashboard": 6, "POST /api/sync": 4, "POST /api/batch": 3,
+        "GET /api/quiz/questions": 1, "GET /api/foundation/prompts": 1, "GET /api/combat/scenarios": 1,
+    },
+}
+
+# ========================
+# RUNNER
+# ========================
+
+async def run_user(user: VirtualUser, mix, deadline: float, think_time: float, samples, statuses):
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    while time.perf_counter() < deadline:
+        route = user.rng.choices(routes, weights)[0]
+        started = time.perf_counter()
+        try:
+            response = await ROUTES[route](user)
+            status = response.status_code
+        except Exception as e:
+            status = f"error:{type(e).__name__}"
+        samples[route].append((time.perf_counter() - started) * 1000)
+        statuses[route][str(status)] += 1
+        if think_time:
+            await asyncio.sleep(user.rng.uniform(0, 2 * think_time))
+
+def summarize(samples, statuses, elapsed: float):
+    routes = {}
+    for route in sorted(samples):
+        latencies = np.array(samples[route])
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        routes[route] = {
+            "requests": len(latencies),
+            "rps": len(latencies) / elapsed,
+            "mean_ms": float(latencies.mean()),
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "max_ms": float(latencies.max()),
+            "statuses": dict(statuses[route]),
+        }
+    total = sum(route["requests"] for route in routes.values())
+    errors = sum(
+        count for route in routes.values() for status, count in route["statuses"].items()
+        if not status.startswith("2")
+    )
+    return {"requests": total, "errors": errors, "rps": total / elapsed, "routes": routes}
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(report):
+    totals = report["totals"]
+    print(f"\n{Colors.BOLD}{'route':<40} {'reqs':>7} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'non-2xx':>8}{Colors.ENDC}")
+    for route, stats in totals["routes"].items():
+        failed = sum(count for status, count in stats["statuses"].items() if not status.startswith("2"))
+        color = Colors.RED if failed else Colors.GREEN
+        print(f"{route:<40} {stats['requests']:>7} {stats['rps']:>8.1f} {stats['p50_ms']:>9.1f} "
+              f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {color}{failed:>8}{Colors.ENDC}")
+    print(f"\n{Colors.BOLD}Total: {totals['requests']} requests, {totals['rps']:.1f} RPS, {totals['errors']} non-2xx{Colors.ENDC}")
+
+async def run_benchmark(args):
+    server = load_server(args)
+    FakeLlmChat.latency = args.llm_latency
+    FakeLlmChat.jitter = args.llm_jitter
+    FakeLlmChat.tokens_per_second = args.llm_tokens_per_second
+    mix = MIXES[args.mix]
+
+    # ASGITransport does not run lifespan events, so start the app by hand
+    await server.app.router.startup()
+    try:
+        tokens = await seed_users(server, args.users)
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as http:
+            rngs = [random.Random(args.seed + i) for i in range(args.users)]
+            users = [VirtualUser(server, http, token, rng) for token, rng in zip(tokens, rngs)]
+
+            if args.warmup:
+                warmup_deadline = time.perf_counter() + args.warmup
+                await asyncio.gather(*[
+                    run_user(user, mix, warmup_deadline, args.think_time, defaultdict(list), defaultdict(lambda: defaultdict(int)))
+                    for user in users
+                ])
+
+            samples = defaultdict(list)
+            statuses = defaultdict(lambda: defaultdict(int))
+            started = time.perf_counter()
+            deadline = started + args.duration
+            await asyncio.gather(*[
+                run_user(user, mix, deadline, args.think_time, samples, statuses)
+                for user in users
+            ])
+            elapsed = time.perf_counter() - started
+    finally:
+        if args.mongo_url and not args.keep_db:
+            await server.client.drop_database(args.db_name)
+        await server.app.router.shutdown()
+
+    return {
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "mix": args.mix,
+            "users": args.users,
+            "duration_seconds": args.duration,
+            "think_time_seconds": args.think_time,
+            "llm_latency_seconds": args.llm_latency,
+            "llm_jitter_seconds": args.llm_jitter,
+            "llm_tokens_per_second": args.llm_tokens_per_second,
+            "llm_recording": args.llm_recording,
+            "database": "mongod" if args.mongo_url else "in-memory",
+            "seed": args.seed,
+        },
+        "elapsed_seconds": elapsed,
+        "totals": summarize(samples, statuses, elapsed),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the Rizz Academy API")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="default", help="route mix to drive")
+    parser.add_argument("--users", type=int, default=50, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="unmeasured seconds before the run")
+    parser.add_argument("--think-time", type=float, default=0, help="mean pause between a user's requests")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="fake LLM reply latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="+/- seconds added to the fake LLM latency")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50, help="fake LLM streaming rate")
+    parser.add_argument("--llm-recording", help="replay recorded LLM exchanges (LLM_MODE=record output) instead of the fake")
+    parser.add_argument("--mongo-url", help="local mongod to use instead of the in-memory stand-in")
+    parser.add_argument("--db-name", default="rizz_benchmark", help="database to seed (dropped afterwards)")
+    parser.add_argument("--keep-db", action="store_true", help="keep the benchmark database on mongod")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the route mix")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to save the JSON results")
+    args = parser.parse_args()
+
+    print(f"{Colors.BOLD}🏋️  Rizz Academy Backend Benchmark{Colors.ENDC}")
+    print(f"Mix: {args.mix}, users: {args.users}, duration: {args.duration}s, "
+          f"database: {args.mongo_url or 'in-memory'}")
+
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
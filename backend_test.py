@@ -7,6 +7,7 @@ Tests all backend APIs including authentication, quiz, progress, foundation, and
 import requests
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Configuration
@@ -285,6 +286,55 @@ def test_authenticated_endpoints():
     else:
         print_error("Combat chat endpoint failed")
 
+def test_progress_update_concurrency():
+    """Test that parallel POST /api/user/progress/update calls never lose XP"""
+    print_test_header("Progress Update Concurrency")
+    
+    headers = {"Authorization": f"Bearer {SESSION_TOKEN}"}
+    
+    response = make_request("GET", "/user/progress", headers=headers)
+    if not response:
+        print_error("Could not read starting progress")
+        return
+    starting_xp = response.json().get("xp", 0)
+    
+    increments = [1, 2, 3, 5, 8] * 10
+    
+    def post_update(xp_earned):
+        return requests.post(
+            f"{BASE_URL}/user/progress/update",
+            params={"xp_earned": xp_earned},
+            headers=headers,
+            timeout=30
+        )
+    
+    print_info(f"Sending {len(increments)} parallel progress updates")
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        responses = list(executor.map(post_update, increments))
+    
+    failures = [r for r in responses if r.status_code != 200]
+    if failures:
+        print_error(f"{len(failures)} updates failed, first status {failures[0].status_code}")
+        return
+    
+    response = make_request("GET", "/user/progress", headers=headers)
+    if not response:
+        print_error("Could not read final progress")
+        return
+    
+    progress = response.json()
+    expected_xp = starting_xp + sum(increments)
+    if progress.get("xp") == expected_xp:
+        print_success(f"Final XP {expected_xp} equals start plus all {len(increments)} increments")
+    else:
+        print_error(f"Expected XP {expected_xp}, got {progress.get('xp')}")
+    
+    expected_level = 1 + expected_xp // 500
+    if progress.get("level") == expected_level:
+        print_success(f"Level {expected_level} consistent with XP")
+    else:
+        print_error(f"Expected level {expected_level}, got {progress.get('level')}")
+
 def test_unauthenticated_access():
     """Test that protected endpoints properly reject unauthenticated requests"""
     print_test_header("Authentication Protection")
@@ -348,6 +398,7 @@ def main():
     test_combat_scenarios()
     test_auth_session_exchange()
     test_authenticated_endpoints()
+    test_progress_update_concurrency()
     test_unauthenticated_access()
     
     print(f"\n{Colors.BOLD}🏁 Testing Complete{Colors.ENDC}")